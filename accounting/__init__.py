@@ -1,11 +1,31 @@
-#You will need to pip install flask and the sqlalchemy extension for flask.
-from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
+#You will need to pip install flask and sqlalchemy.
 
-# Initialize the application.
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+# Settings from config.py, read without Flask so headless scripts and
+# workers never import the web layer.
+import config
+from engine import TunedSQLAlchemy, load_config
+settings = load_config(config)
 
-# Import the views file for routing.
-import views
+# SQLAlchemy with the sqlite pragmas and pool from config.py.
+db = TunedSQLAlchemy(settings)
+
+
+def create_app():
+    """Returns a new Flask app serving the views and /metrics. Flask and
+    the views are only imported here.
+    """
+    from flask import Flask
+    import metrics
+    import views
+
+    # Initialize the application.
+    app = Flask(__name__)
+    app.config.update(settings)
+    db.init_app(app)
+
+    # Routing for the server.
+    views.init_app(app)
+
+    # Per request SQL and timing metrics, off unless METRICS_ENABLED is set.
+    metrics.init_app(app)
+    return app
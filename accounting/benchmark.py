@@ -0,0 +1,452 @@
+#!/user/bin/env python2.7
+
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+
+from accounting import create_app, db, settings
+from billing import invoice_schedule
+from instrumentation import QueryRecorder
+from ledger import rebuild_entries
+from models import Contact, Invoice, Payment, Policy
+from timeline import invalidate_timelines
+from tools import PolicyAccounting
+
+"""
+#######################################################
+Synthetic books and timings for PolicyAccounting.
+
+generate_book fills the configured db with policies,
+invoices, payments and ledger entries. run_benchmarks
+times the hot PolicyAccounting calls and the policy
+view against it, and run_concurrency_benchmark mixes
+reader and make_payment writer threads. time_imports
+compares the startup of headless scripts and workers
+with the web app's. Several
+benchmarks write, so point them at a throwaway book
+(run from an empty directory).
+#######################################################
+"""
+
+# (value, weight) mixes the generated policies are drawn from
+SCHEDULE_MIX = [('Annual', 25), ('Two-Pay', 15), ('Quarterly', 30), ('Monthly', 30)]
+PAYMENT_HABITS = [('on_time', 70), ('late', 15), ('partial', 10), ('never', 5)]
+
+# policies written per transaction while generating
+GENERATE_CHUNK_SIZE = 10000
+
+# named insureds per agent in a generated book
+POLICIES_PER_AGENT = 100
+
+# metrics compare_results treats as regressions when they grow
+COMPARED_METRICS = ('queries_per_call', 'p50_ms', 'p95_ms')
+
+# (name, statement) pairs time_imports runs in fresh interpreters
+IMPORT_TARGETS = [('headless', "import accounting.tools"),
+                  ('web', "import accounting; accounting.create_app()")]
+
+IMPORT_PROBE = """import json, sys, time
+started = time.time()
+%s
+print json.dumps([(time.time() - started) * 1000, len(sys.modules), 'flask' in sys.modules])
+"""
+
+
+def weighted_choice(rng, choices):
+    """Returns a value from (value, weight) pairs."""
+    point = rng.uniform(0, sum(weight for value, weight in choices))
+    for value, weight in choices:
+        point -= weight
+        if point <= 0:
+            return value
+    return choices[-1][0]
+
+
+def next_id(model):
+    """Returns the id after the largest one in model's table."""
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def payments_for(rng, habit, invoices, as_of):
+    """Returns (transaction_date, amount_paid) for a policy's invoices.
+
+    habit -- one of PAYMENT_HABITS
+    invoices -- invoice_schedule rows
+    as_of -- Date object, later payments have not happened yet
+    """
+    payments = []
+    if habit == 'never':
+        return payments
+    for bill_date, due_date, cancel_date, amount_due in invoices:
+        if habit == 'late':
+            transaction_date = due_date + timedelta(days=rng.randint(1, 21))
+        else:
+            transaction_date = bill_date + timedelta(days=rng.randint(0, 28))
+        if transaction_date > as_of:
+            break
+        if habit == 'partial':
+            amount_due = amount_due / 2
+        payments.append((transaction_date, amount_due))
+    return payments
+
+
+def generate_book(policies, seed=0, start_date=date(2014, 1, 1), days=730, as_of=None):
+    """Adds a synthetic book to the db and returns counts of what was made.
+
+    Policies get a mix of billing schedules, premiums and payment habits,
+    a year of invoices and the payments made by as_of. The ledger is
+    rebuilt once at the end.
+
+    policies -- number of policies to add
+    seed -- random seed, the same seed builds the same book
+    start_date -- earliest effective date
+    days -- effective dates are spread over this many days from start_date
+    as_of -- Date object payments are generated up to (defaults to today)
+    """
+    if not as_of:
+        as_of = datetime.now().date()
+
+    started = time.time()
+    rng = random.Random(seed)
+    counts = {'policies': 0, 'contacts': 0, 'invoices': 0, 'payments': 0}
+
+    contact_id = next_id(Contact)
+    policy_id = next_id(Policy)
+    agent_ids = []
+    while counts['policies'] < policies:
+        chunk = min(GENERATE_CHUNK_SIZE, policies - counts['policies'])
+        contact_rows, policy_rows, invoice_rows, payment_rows = [], [], [], []
+
+        for i in range(chunk):
+            if not agent_ids or len(agent_ids) * POLICIES_PER_AGENT <= counts['policies'] + i:
+                contact_rows.append({'id': contact_id, 'name': u"Agent %d" % contact_id,
+                                     'role': u'Agent'})
+                agent_ids.append(contact_id)
+                contact_id += 1
+            insured_id = contact_id
+            contact_rows.append({'id': insured_id, 'name': u"Insured %d" % insured_id,
+                                 'role': u'Named Insured'})
+            contact_id += 1
+
+            effective_date = start_date + timedelta(days=rng.randint(0, days))
+            billing_schedule = weighted_choice(rng, SCHEDULE_MIX)
+            annual_premium = rng.randint(24, 600) * 5
+            policy_rows.append({'id': policy_id,
+                                'policy_number': u"Policy %d" % policy_id,
+                                'effective_date': effective_date,
+                                'status': u'Active',
+                                'billing_schedule': billing_schedule,
+                                'annual_premium': annual_premium,
+                                'named_insured': insured_id,
+                                'agent': rng.choice(agent_ids)})
+
+            invoices = invoice_schedule(effective_date, billing_schedule, annual_premium)
+            for bill_date, due_date, cancel_date, amount_due in invoices:
+                invoice_rows.append({'policy_id': policy_id,
+                                     'bill_date': bill_date,
+                                     'due_date': due_date,
+                                     'cancel_date': cancel_date,
+                                     'amount_due': amount_due,
+                                     'deleted': False})
+            habit = weighted_choice(rng, PAYMENT_HABITS)
+            for transaction_date, amount_paid in payments_for(rng, habit, invoices, as_of):
+                payment_rows.append({'policy_id': policy_id,
+                                     'contact_id': insured_id,
+                                     'amount_paid': amount_paid,
+                                     'transaction_date': transaction_date})
+            policy_id += 1
+
+        for model, rows in ((Contact, contact_rows), (Policy, policy_rows),
+                            (Invoice, invoice_rows), (Payment, payment_rows)):
+            if rows:
+                db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+
+        counts['policies'] += chunk
+        counts['contacts'] += len(contact_rows)
+        counts['invoices'] += len(invoice_rows)
+        counts['payments'] += len(payment_rows)
+        print "Generated %d of %d policies" % (counts['policies'], policies)
+
+    rebuild_entries()
+    counts['seconds'] = round(time.time() - started, 3)
+    return counts
+
+
+################################
+# Benchmarks, each function sets up one policy
+# and returns the call to time.
+################################
+
+def bench_return_account_balance(policy_id, date_cursor):
+    pa = PolicyAccounting(policy_id, read_only=True)
+    return lambda: pa.return_account_balance(date_cursor)
+
+
+def bench_evaluate_cancellation_pending(policy_id, date_cursor):
+    pa = PolicyAccounting(policy_id, read_only=True)
+    return lambda: pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor)
+
+
+def bench_evaluate_cancel(policy_id, date_cursor):
+    pa = PolicyAccounting(policy_id)
+    return lambda: pa.evaluate_cancel(date_cursor)
+
+
+def bench_make_invoices(policy_id, date_cursor):
+    pa = PolicyAccounting(policy_id)
+    return lambda: pa.make_invoices()
+
+
+def bench_change_billing_schedule(policy_id, date_cursor):
+    # rebilling onto the same schedule and date keeps the book comparable
+    pa = PolicyAccounting(policy_id)
+    return lambda: pa.change_billing_schedule(pa.policy.billing_schedule,
+                                              pa.policy.effective_date)
+
+
+def bench_view(policy_id, date_cursor):
+    client = create_app().test_client()
+    url = "/view/%s/%d/%d/%d" % (policy_id, date_cursor.year, date_cursor.month, date_cursor.day)
+    return lambda: client.get(url)
+
+
+BENCHMARKS = [('return_account_balance', bench_return_account_balance),
+              ('evaluate_cancellation_pending_due_to_non_pay', bench_evaluate_cancellation_pending),
+              ('evaluate_cancel', bench_evaluate_cancel),
+              ('make_invoices', bench_make_invoices),
+              ('change_billing_schedule', bench_change_billing_schedule),
+              ('view', bench_view)]
+
+
+def percentile(samples, fraction):
+    """Returns the nearest rank percentile of samples."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0
+    return ordered[min(int(round(fraction * len(ordered) + 0.5)) - 1, len(ordered) - 1)]
+
+
+def peak_memory_kb():
+    """Returns the process's peak resident memory in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def time_calls(prepare, policy_ids, date_cursor):
+    """Times one benchmark over policy_ids and returns its statistics.
+
+    Each call starts from an empty session and timeline cache, like the
+    first request for a policy would.
+    """
+    latencies = []
+    queries = []
+    memory_before = peak_memory_kb()
+    for policy_id in policy_ids:
+        db.session.remove()
+        db.read_session.remove()
+        call = prepare(policy_id, date_cursor)
+        invalidate_timelines()
+        with QueryRecorder() as recorder:
+            started = time.time()
+            call()
+            latencies.append((time.time() - started) * 1000)
+        queries.append(recorder.count)
+    db.session.remove()
+
+    return {'calls': len(latencies),
+            'queries_per_call': round(float(sum(queries)) / max(len(queries), 1), 2),
+            'max_queries': max(queries or [0]),
+            'mean_ms': round(sum(latencies) / max(len(latencies), 1), 3),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'peak_memory_kb': peak_memory_kb(),
+            'memory_growth_kb': peak_memory_kb() - memory_before}
+
+
+def run_benchmarks(sample_size=100, date_cursor=None, seed=0, names=None):
+    """Times each benchmark on a random sample of policies.
+
+    sample_size -- policies each benchmark is run against
+    date_cursor -- Date object the calls are made for (defaults to today)
+    seed -- random seed picking the sample
+    names -- only run these benchmarks (defaults to all of BENCHMARKS)
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    sample = random.Random(seed).sample(policy_ids, min(sample_size, len(policy_ids)))
+
+    results = {'meta': {'started': datetime.now().isoformat(),
+                        'policies': len(policy_ids),
+                        'sample_size': len(sample),
+                        'date_cursor': date_cursor.isoformat(),
+                        'python': platform.python_version()},
+               'benchmarks': {}}
+    for name, prepare in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results['benchmarks'][name] = time_calls(prepare, sample, date_cursor)
+    return results
+
+
+def save_results(results, path):
+    """Writes results from run_benchmarks to path as JSON."""
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """Reads results written by save_results."""
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def compare_results(baseline, current, tolerance=0.10):
+    """Returns (benchmark, metric, baseline, current) for every metric in
+    COMPARED_METRICS that grew by more than tolerance.
+    """
+    regressions = []
+    for name, stats in sorted(current['benchmarks'].items()):
+        old_stats = baseline['benchmarks'].get(name)
+        if not old_stats:
+            continue
+        for metric in COMPARED_METRICS:
+            if stats[metric] > old_stats[metric] * (1 + tolerance):
+                regressions.append((name, metric, old_stats[metric], stats[metric]))
+    return regressions
+
+
+def print_results(results):
+    """Prints one line per benchmark."""
+    print "%d policies, %d sampled, date %s" % (results['meta']['policies'],
+                                                results['meta']['sample_size'],
+                                                results['meta']['date_cursor'])
+    print "%-45s %8s %9s %9s %9s %10s" % ("benchmark", "queries", "p50 ms", "p95 ms",
+                                          "p99 ms", "peak KB")
+    for name, stats in sorted(results['benchmarks'].items()):
+        print "%-45s %8.2f %9.3f %9.3f %9.3f %10d" % (name, stats['queries_per_call'],
+                                                      stats['p50_ms'], stats['p95_ms'],
+                                                      stats['p99_ms'], stats['peak_memory_kb'])
+
+
+def time_imports(runs=5, targets=IMPORT_TARGETS):
+    """Returns {name: stats} with the median milliseconds each target
+    statement takes in a fresh interpreter, the modules it leaves loaded
+    and whether Flask is among them. This is the startup a script or
+    worker pays before it does any work.
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root,
+                                                               os.environ.get('PYTHONPATH')])))
+    results = {}
+    for name, statement in targets:
+        timings = []
+        for i in range(runs):
+            milliseconds, modules, flask_loaded = json.loads(subprocess.check_output(
+                [sys.executable, "-c", IMPORT_PROBE % statement], env=env))
+            timings.append(milliseconds)
+        results[name] = {'statement': statement,
+                         'median_ms': round(percentile(timings, 0.5), 1),
+                         'modules': modules,
+                         'flask': flask_loaded}
+    return results
+
+
+def print_import_results(results):
+    """Prints one line per import target."""
+    print "%-10s %10s %8s %6s  %s" % ("target", "median ms", "modules", "flask", "statement")
+    for name, stats in sorted(results.items()):
+        print "%-10s %10.1f %8d %6s  %s" % (name, stats['median_ms'], stats['modules'],
+                                            "yes" if stats['flask'] else "no",
+                                            stats['statement'])
+
+
+def run_concurrency_benchmark(readers=4, writers=1, seconds=5.0, date_cursor=None, seed=0):
+    """Runs reader and writer threads against the book for a while and
+    returns the throughput, latency and lock errors of each kind.
+
+    Readers load a read only PolicyAccounting and evaluate its balance and
+    status, writers make a small agent payment on a random policy.
+
+    readers, writers -- threads of each kind
+    seconds -- how long they run for
+    date_cursor -- Date object the calls are made for (defaults to today)
+    seed -- random seed picking the policies
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    agent_ids = [row[0] for row in db.session.execute(select([Contact.__table__.c.id])
+                                     .where(Contact.__table__.c.role == u'Agent'))]
+    db.session.remove()
+
+    def read(policy_id, rng):
+        pa = PolicyAccounting(policy_id, read_only=True)
+        pa.return_account_balance(date_cursor)
+        pa.evaluate_status(date_cursor)
+
+    def write(policy_id, rng):
+        PolicyAccounting(policy_id).make_payment(rng.choice(agent_ids), date_cursor, 1)
+
+    totals = {'readers': {'operations': 0, 'errors': 0, 'latencies': []},
+              'writers': {'operations': 0, 'errors': 0, 'latencies': []}}
+    lock = threading.Lock()
+    stop_at = time.time() + seconds
+
+    def work(kind, call, rng):
+        operations = errors = 0
+        latencies = []
+        while time.time() < stop_at:
+            started = time.time()
+            try:
+                call(rng.choice(policy_ids), rng)
+                operations += 1
+                latencies.append((time.time() - started) * 1000)
+            except OperationalError:
+                # "database is locked" once the busy timeout runs out
+                errors += 1
+                db.session.rollback()
+            finally:
+                db.session.remove()
+                db.read_session.remove()
+        with lock:
+            totals[kind]['operations'] += operations
+            totals[kind]['errors'] += errors
+            totals[kind]['latencies'].extend(latencies)
+
+    threads = [threading.Thread(target=work, args=('readers', read, random.Random(seed + i)))
+               for i in range(readers)]
+    threads += [threading.Thread(target=work, args=('writers', write, random.Random(-seed - i - 1)))
+                for i in range(writers)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    results = {'meta': {'readers': readers, 'writers': writers,
+                        'seconds': round(elapsed, 3),
+                        'journal_mode': db.session.execute("PRAGMA journal_mode").scalar(),
+                        'pool_size': settings.get('SQLITE_POOL_SIZE'),
+                        'read_connections': bool(settings.get('SQLITE_READ_CONNECTIONS'))}}
+    db.session.remove()
+    for kind, stats in totals.items():
+        latencies = stats.pop('latencies')
+        stats['per_second'] = round(stats['operations'] / elapsed, 2)
+        stats['p50_ms'] = round(percentile(latencies, 0.50), 3)
+        stats['p95_ms'] = round(percentile(latencies, 0.95), 3)
+        results[kind] = stats
+    return results
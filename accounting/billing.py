@@ -0,0 +1,153 @@
+#!/user/bin/env python2.7
+
+from calendar import monthrange
+from datetime import date, timedelta
+
+"""
+#######################################################
+Invoice date and amount math shared by make_invoices
+and the bulk billing commands. Nothing here touches
+the db.
+
+Schedules are built from templates cached by billing
+schedule and effective-date day of month, which keep
+each invoice's year and month offsets, so billing a
+policy is a few date() calls instead of relativedelta.
+#######################################################
+"""
+
+# months covered by one invoice on each billing schedule
+billing_to_months = {'Annual': 12, 'Two-Pay': 6, 'Quarterly': 3, 'Monthly': 1}
+
+# invoices are due a month after billing and cancel two weeks after that
+DUE_MONTHS = 1
+CANCEL_DAYS = timedelta(days=14)
+
+# (billing_schedule, invoices, day of month) -> ScheduleTemplate
+_templates = {}
+
+
+def month_day(year, month, day):
+    """Returns day clamped to the length of month."""
+    if day <= 28:
+        return day
+    return min(day, monthrange(year, month)[1])
+
+
+class ScheduleTemplate(object):
+    """
+     Month offsets for one billing schedule, invoice count and
+     effective-date day of month. The year and month of every bill and
+     due date are worked out once per starting month and kept, so dates
+     only need the day clamped to the month's length.
+    """
+    __slots__ = ('day', 'month_offsets', 'invoices_needed', 'offsets_by_month')
+
+    def __init__(self, months_in_billing_period, invoices_needed, day):
+        self.day = day
+        self.invoices_needed = invoices_needed
+        self.month_offsets = tuple(i * months_in_billing_period for i in range(invoices_needed))
+        # start month -> offsets, see offsets
+        self.offsets_by_month = {}
+
+    def split(self, annual_premium):
+        """Splits the premium evenly, the remainder goes on the first invoice.
+        A divmod per call, nothing is cached.
+        """
+        installment, remainder = divmod(annual_premium, self.invoices_needed)
+        return [installment + remainder] + [installment] * (self.invoices_needed - 1)
+
+    def offsets(self, start_month):
+        """Returns (bill years, bill month, due years, due month) for each
+        invoice of a term starting in start_month, years counted from the
+        effective date's year.
+        """
+        offsets = self.offsets_by_month.get(start_month)
+        if offsets is None:
+            offsets = []
+            for months in self.month_offsets:
+                bill_index = start_month - 1 + months
+                due_index = bill_index + DUE_MONTHS
+                offsets.append((bill_index // 12, bill_index % 12 + 1,
+                                due_index // 12, due_index % 12 + 1))
+            offsets = self.offsets_by_month[start_month] = tuple(offsets)
+        return offsets
+
+    def dates(self, effective_date):
+        """Returns (bill_date, due_date, cancel_date) for each invoice."""
+        year = effective_date.year
+        schedule = []
+        for bill_years, bill_month, due_years, due_month in self.offsets(effective_date.month):
+            bill_date = date(year + bill_years, bill_month,
+                             month_day(year + bill_years, bill_month, self.day))
+            # due a month after the bill date, aiming for the bill date's day
+            due_date = date(year + due_years, due_month,
+                            month_day(year + due_years, due_month, bill_date.day))
+            schedule.append((bill_date, due_date, due_date + CANCEL_DAYS))
+        return schedule
+
+
+def schedule_template(billing_schedule, invoices_needed, day):
+    """Returns the cached ScheduleTemplate, building it on first use."""
+    key = (billing_schedule, invoices_needed, day)
+    template = _templates.get(key)
+    if template is None:
+        template = ScheduleTemplate(billing_to_months.get(billing_schedule, 12),
+                                    invoices_needed, day)
+        _templates[key] = template
+    return template
+
+
+def invoice_schedule(effective_date, billing_schedule, annual_premium, end_date_cursor=None):
+    """Returns (bill_date, due_date, cancel_date, amount_due) for each invoice
+    of a policy term. Unknown billing schedules are billed annually.
+
+    effective_date -- Date object the first invoice is billed on
+    billing_schedule -- one of billing_to_months
+    annual_premium -- amount billed over the term
+    end_date_cursor -- Date object the term ends (defaults to a year out)
+    """
+    invoices_needed = 1
+    if billing_schedule in billing_to_months and billing_schedule != 'Annual':
+        # find amount of months between end_date_cursor and effective_date
+        if end_date_cursor:
+            months_left = (end_date_cursor - effective_date).days / 30
+        else:
+            months_left = 365 / 30
+        invoices_needed = max(months_left / billing_to_months[billing_schedule], 1)
+
+    template = schedule_template(billing_schedule, invoices_needed, effective_date.day)
+    return [dates + (amount_due,) for dates, amount_due in
+            zip(template.dates(effective_date), template.split(annual_premium))]
+
+
+def plan_rebilling(timeline, effective_date, new_billing_schedule, date_cursor):
+    """Returns what change_billing_schedule does to one policy, without
+    touching anything.
+
+    Every existing invoice is soft deleted if the policy's balance on its
+    due date is zero and hard deleted otherwise, one pass over the due
+    dates. What is owed through the end of the old term becomes the
+    premium of the new term, which starts on date_cursor.
+
+    timeline -- the policy's PolicyTimeline
+    effective_date -- Date object the current term started on
+    new_billing_schedule -- one of billing_to_months
+    date_cursor -- Date object the new schedule starts on
+    """
+    invoices = sorted(timeline.invoices, key=lambda invoice: (invoice[1], invoice[4]))
+    due_balances = timeline.balances_at([invoice[1] for invoice in invoices])
+    soft_deleted = [invoice[4] for invoice, balance in zip(invoices, due_balances)
+                    if balance == 0]
+    hard_deleted = [invoice[4] for invoice, balance in zip(invoices, due_balances)
+                    if balance != 0]
+
+    annual_premium = timeline.balance(effective_date + timedelta(days=365))
+    return {'policy_id': timeline.policy_id,
+            'billing_schedule': new_billing_schedule,
+            'effective_date': date_cursor,
+            'annual_premium': annual_premium,
+            'soft_deleted': soft_deleted,
+            'hard_deleted': hard_deleted,
+            'invoices': invoice_schedule(date_cursor, new_billing_schedule, annual_premium,
+                                         date_cursor + timedelta(days=365))}
@@ -0,0 +1,83 @@
+#!/user/bin/env python2.7
+
+import threading
+import time
+from collections import OrderedDict
+
+"""
+#######################################################
+Small in-process caches shared by the accounting code.
+#######################################################
+"""
+
+_missing = object()
+
+
+class BoundedCache(object):
+    """
+     Thread safe LRU cache with an optional time to live per entry.
+    """
+    def __init__(self, max_size=1024, ttl=None):
+        """Creates an empty cache.
+
+        max_size -- entries kept before the least recently used is evicted
+        ttl -- seconds an entry stays fresh (defaults to forever)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by every invalidation, see set
+        self.version = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value for key or default."""
+        with self.lock:
+            value, expires = self.entries.pop(key, (_missing, None))
+            if value is _missing or (expires is not None and expires <= time.time()):
+                self.misses += 1
+                return default
+            self.entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version=None):
+        """Caches value under key, evicting the least recently used entry.
+
+        version -- self.version from before value was read, the value is
+                   dropped if an invalidation happened since (defaults to
+                   always caching)
+        """
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.entries.pop(key, None)
+            expires = time.time() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops key from the cache."""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.version += 1
+
+    def clear(self):
+        """Drops every entry, the statistics are kept."""
+        with self.lock:
+            self.entries.clear()
+            self.version += 1
+
+    def stats(self):
+        """Returns hit, miss and size counters."""
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self.entries),
+                    'max_size': self.max_size}
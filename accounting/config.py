@@ -1,3 +1,43 @@
 import os
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+# ACCOUNTING_DB points a run at another sqlite file
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath(os.environ.get('ACCOUNTING_DB',
+                                                                        "accounting.sqlite"))
+# name of an in-memory db to use instead of the file, see engine.py
+SQLITE_MEMORY_DB = os.environ.get('ACCOUNTING_MEMORY_DB') or None
+
+# pragmas run on every new sqlite connection, None leaves sqlite's default
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_BUSY_TIMEOUT = 5000
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_CACHE_SIZE = -16000
+# connections kept open per process, None reconnects for every session
+SQLITE_POOL_SIZE = 5
+# send read only work to a separate pool of query_only connections
+SQLITE_READ_CONNECTIONS = False
+
+# write policy logs from a background thread instead of the request thread
+LOG_QUEUED = False
+# ACCOUNTING_LOG_DIR points the policy logs at another directory
+LOG_DIR = os.environ.get('ACCOUNTING_LOG_DIR', "Logs")
+
+# contact names kept in memory for the policy view
+CONTACT_CACHE_SIZE = 10000
+CONTACT_CACHE_TTL = 300
+
+# policy timelines kept in memory for balance and cancellation lookups, writes
+# from other processes (runnightly.py, runimport.py) show up after the ttl for
+# read only lookups, writable PolicyAccounting checks the ledger version
+TIMELINE_CACHE_SIZE = 10000
+TIMELINE_CACHE_TTL = 30
+# rendered /view pages, served again while the policy's ETag holds
+PAGE_CACHE_SIZE = 1000
+# invoices and payments per page of a policy's history
+HISTORY_PAGE_SIZE = 50
+
+# per request query/timing headers and histograms served at /metrics
+METRICS_ENABLED = False
+METRICS_SLOWEST_STATEMENTS = 5
+# sample the stack of requests served on the main thread while metrics are on
+METRICS_PROFILE = False
+METRICS_PROFILE_INTERVAL = 0.005
@@ -0,0 +1,39 @@
+#!/user/bin/env python2.7
+
+from accounting import db, settings
+from cache import BoundedCache
+from models import Contact
+
+"""
+#######################################################
+Cached contact name lookups.
+#######################################################
+"""
+
+contact_name_cache = BoundedCache(settings.get('CONTACT_CACHE_SIZE', 10000),
+                                  settings.get('CONTACT_CACHE_TTL', 300))
+
+
+def contact_names(contact_ids, session=None):
+    """Returns {contact_id: name}, reading the uncached ones in one query.
+
+    contact_ids -- primary keys of contacts, None entries are skipped
+    session -- session to read with (defaults to db.session)
+    """
+    names = {}
+    missing = []
+    for contact_id in set(contact_ids):
+        if contact_id is None:
+            continue
+        name = contact_name_cache.get(contact_id)
+        if name is None:
+            missing.append(contact_id)
+        else:
+            names[contact_id] = name
+
+    if missing:
+        for contact_id, name in (session or db.session).query(Contact.id, Contact.name)\
+                                                       .filter(Contact.id.in_(missing)):
+            contact_name_cache.set(contact_id, name)
+            names[contact_id] = name
+    return names
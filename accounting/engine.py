@@ -0,0 +1,214 @@
+#!/user/bin/env python2.7
+
+import sqlite3
+import threading
+from functools import partial
+
+import sqlalchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import NullPool, QueuePool
+
+"""
+#######################################################
+The db: models, sessions and engine built from the
+settings in config.py with plain SQLAlchemy, so
+headless code never imports Flask. create_app hooks
+it into the web app with init_app.
+
+Every new connection gets the SQLITE_* pragmas from
+config.py, and SQLITE_POOL_SIZE connections are kept
+open per process instead of reconnecting per session.
+With SQLITE_READ_CONNECTIONS set, read only work goes
+through db.read_session, a second pool whose
+connections run with query_only so they never take
+the write lock. In WAL mode those reads do not wait
+on writers either.
+
+With SQLITE_MEMORY_DB set the file is left alone and
+every connection opens the same named shared-cache
+in-memory db instead, kept alive for the life of the
+process. That is meant for tests and benchmarks: the
+db is private to the process (forked workers cannot
+see it) and shared-cache connections fail with "table
+is locked" instead of waiting on one another.
+#######################################################
+"""
+
+# oldest sqlite library the queries run on: VACUUM INTO (snapshots.py) is
+# 3.27, window functions (reports.py) 3.25 and row values (history.py) 3.15
+MIN_SQLITE_VERSION = (3, 27, 0)
+
+# (pragma, config key) applied in order to every new connection
+PRAGMA_SETTINGS = [('journal_mode', 'SQLITE_JOURNAL_MODE'),
+                   ('busy_timeout', 'SQLITE_BUSY_TIMEOUT'),
+                   ('synchronous', 'SQLITE_SYNCHRONOUS'),
+                   ('cache_size', 'SQLITE_CACHE_SIZE')]
+
+
+def pragma_statements(config):
+    """Returns the PRAGMA statements for the SQLITE_* settings in config."""
+    return ["PRAGMA %s = %s" % (pragma, config[key]) for pragma, key in PRAGMA_SETTINGS
+            if config.get(key) is not None]
+
+
+def listen_for_connections(engine, statements):
+    """Runs statements on every connection engine opens."""
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+    event.listen(engine, 'connect', apply_pragmas)
+
+
+def check_sqlite_version(version=sqlite3.sqlite_version):
+    """Raises RuntimeError if the sqlite library is older than
+    MIN_SQLITE_VERSION.
+
+    version -- sqlite library version string (defaults to the one the
+               sqlite3 module is linked against)
+    """
+    if tuple(int(part) for part in version.split(".")[:3]) < MIN_SQLITE_VERSION:
+        raise RuntimeError("SQLite %s or newer is required, sqlite3 is linked against %s"
+                           % (".".join(map(str, MIN_SQLITE_VERSION)), version))
+
+
+def is_sqlite_file(info):
+    return info.drivername == 'sqlite' and info.database not in (None, '', ':memory:')
+
+
+def memory_connector(name):
+    """Returns a function connecting to the shared-cache in-memory db name."""
+    uri = "file:%s?mode=memory&cache=shared" % name
+    # the pool hands a connection to one thread at a time
+    return lambda: sqlite3.connect(uri, check_same_thread=False)
+
+
+def pool_options(config):
+    """Returns create_engine options for a pool of SQLITE_POOL_SIZE connections,
+    to SQLITE_MEMORY_DB if it is set.
+    """
+    options = {}
+    if config.get('SQLITE_POOL_SIZE'):
+        # the pool hands a connection to one thread at a time
+        options = {'poolclass': QueuePool,
+                   'pool_size': config['SQLITE_POOL_SIZE'],
+                   'connect_args': {'check_same_thread': False}}
+    if config.get('SQLITE_MEMORY_DB'):
+        options['creator'] = memory_connector(config['SQLITE_MEMORY_DB'])
+    return options
+
+
+def load_config(module):
+    """Returns the upper case settings of a config module as a dict."""
+    return dict((key, getattr(module, key)) for key in dir(module) if key.isupper())
+
+
+class EngineSession(orm.Session):
+    """
+     A session bound to the db's engine, which is created the first
+     time a session needs it.
+    """
+    def __init__(self, db, **options):
+        self.db = db
+        orm.Session.__init__(self, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        return self.db.engine
+
+
+class QueryProperty(object):
+    """Model.query, a query for the model on db.session."""
+    def __init__(self, db):
+        self.db = db
+
+    def __get__(self, instance, model):
+        return orm.Query(model, session=self.db.session())
+
+
+class TunedSQLAlchemy(object):
+    """
+     SQLAlchemy with pooled, tuned sqlite connections and an optional
+     read only session, laid out like Flask-SQLAlchemy was: db.Model,
+     Model.query, db.session, db.engine and the sqlalchemy names
+     (db.Column, db.INTEGER, ...).
+    """
+    def __init__(self, config):
+        self.config = config
+        self.engine_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.tuned_engine = None
+        self.read_sessions = None
+        # holds SQLITE_MEMORY_DB open, it is dropped with its last connection
+        self.memory_db = None
+
+        # changes only reach the db on flush or commit, as with Flask-SQLAlchemy
+        self.session = orm.scoped_session(partial(EngineSession, self, autoflush=False))
+        self.Model = declarative_base(name='Model')
+        self.Model.query = QueryProperty(self)
+        for module in (sqlalchemy, orm):
+            for name in module.__all__:
+                if not hasattr(self, name):
+                    setattr(self, name, getattr(module, name))
+
+    def init_app(self, app):
+        """Removes the sessions at the end of every request to app."""
+        @app.teardown_request
+        def remove_sessions(exception=None):
+            self.session.remove()
+            if self.read_sessions is not None:
+                self.read_sessions.remove()
+
+    @property
+    def metadata(self):
+        return self.Model.metadata
+
+    @property
+    def engine(self):
+        if self.tuned_engine is None:
+            with self.engine_lock:
+                if self.tuned_engine is None:
+                    self.tuned_engine = self.create_tuned_engine()
+        return self.tuned_engine
+
+    def create_tuned_engine(self):
+        info = make_url(self.config['SQLALCHEMY_DATABASE_URI'])
+        if info.drivername == 'sqlite':
+            check_sqlite_version()
+        if not is_sqlite_file(info):
+            return create_engine(info, convert_unicode=True)
+
+        # without SQLITE_POOL_SIZE every session opens its own connection
+        options = {'poolclass': NullPool}
+        options.update(pool_options(self.config))
+        engine = create_engine(info, convert_unicode=True, **options)
+        listen_for_connections(engine, pragma_statements(self.config))
+        if self.config.get('SQLITE_MEMORY_DB'):
+            self.memory_db = memory_connector(self.config['SQLITE_MEMORY_DB'])()
+        return engine
+
+    def create_all(self):
+        self.metadata.create_all(bind=self.engine)
+
+    def drop_all(self):
+        self.metadata.drop_all(bind=self.engine)
+
+    @property
+    def read_session(self):
+        """The session read only work should use, the query_only one when
+        SQLITE_READ_CONNECTIONS is set and db.session otherwise.
+        """
+        if not self.config.get('SQLITE_READ_CONNECTIONS'):
+            return self.session
+
+        if self.read_sessions is None:
+            with self.read_lock:
+                if self.read_sessions is None:
+                    engine = create_engine(self.engine.url, convert_unicode=True,
+                                           **pool_options(self.config))
+                    listen_for_connections(engine, pragma_statements(self.config) +
+                                                   ["PRAGMA query_only = ON"])
+                    self.read_sessions = orm.scoped_session(orm.sessionmaker(bind=engine))
+        return self.read_sessions
@@ -0,0 +1,184 @@
+#!/user/bin/env python2.7
+
+import csv
+import heapq
+import json
+import zlib
+from cStringIO import StringIO
+
+from sqlalchemy import select
+
+from accounting import db
+from models import Invoice, Payment, Policy
+
+"""
+#######################################################
+Streaming export of every invoice and payment in the
+book with each policy's running balance.
+
+Invoices and payments are read with one query each,
+ordered by policy and date, and merged as they stream
+in, so only a batch of rows is held at a time however
+big the book is. Output is CSV or NDJSON, optionally
+gzipped, and comes out a batch at a time for writing
+to a file or a streamed response.
+#######################################################
+"""
+
+invoices_table = Invoice.__table__
+payments_table = Payment.__table__
+policies_table = Policy.__table__
+
+# rows fetched from the db and written out per batch
+EXPORT_BATCH_SIZE = 2000
+
+EXPORT_COLUMNS = ['policy_id', 'policy_number', 'kind', 'invoice_id', 'payment_id',
+                  'date', 'due_date', 'cancel_date', 'deleted', 'contact_id',
+                  'amount', 'balance']
+
+EXPORT_FORMATS = {'csv': "text/csv", 'ndjson': "application/x-ndjson"}
+
+
+def iter_batches(result, batch_size=EXPORT_BATCH_SIZE):
+    """Yields every row of a result, fetching batch_size rows at a time."""
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def iter_export_rows(as_of=None, session=None):
+    """Yields a tuple of EXPORT_COLUMNS for every invoice and payment,
+    ordered by policy and date with invoices before payments on the same
+    day, the order the ledger replays them in.
+
+    as_of -- Date object, leaves out later rows (defaults to no limit)
+    session -- session to read with (defaults to db.read_session)
+    """
+    invoice_query = select([invoices_table.c.policy_id,
+                            invoices_table.c.bill_date,
+                            invoices_table.c.id,
+                            policies_table.c.policy_number,
+                            invoices_table.c.due_date,
+                            invoices_table.c.cancel_date,
+                            invoices_table.c.deleted,
+                            invoices_table.c.amount_due])\
+                    .where(policies_table.c.id == invoices_table.c.policy_id)\
+                    .order_by(invoices_table.c.policy_id,
+                              invoices_table.c.bill_date,
+                              invoices_table.c.id)
+    payment_query = select([payments_table.c.policy_id,
+                            payments_table.c.transaction_date,
+                            payments_table.c.id,
+                            policies_table.c.policy_number,
+                            payments_table.c.contact_id,
+                            payments_table.c.amount_paid])\
+                    .where(policies_table.c.id == payments_table.c.policy_id)\
+                    .order_by(payments_table.c.policy_id,
+                              payments_table.c.transaction_date,
+                              payments_table.c.id)
+    if as_of:
+        invoice_query = invoice_query.where(invoices_table.c.bill_date <= as_of)
+        payment_query = payment_query.where(payments_table.c.transaction_date <= as_of)
+
+    session = session or db.read_session
+    invoice_rows = session.execute(invoice_query.execution_options(stream_results=True))
+    payment_rows = session.execute(payment_query.execution_options(stream_results=True))
+
+    # (policy_id, date, 0 for invoices and 1 for payments, id, row)
+    events = heapq.merge(((row[0], row[1], 0, row[2], row)
+                          for row in iter_batches(invoice_rows)),
+                         ((row[0], row[1], 1, row[2], row)
+                          for row in iter_batches(payment_rows)))
+
+    policy_id = balance = None
+    for event_policy_id, event_date, order, row_id, row in events:
+        if event_policy_id != policy_id:
+            policy_id, balance = event_policy_id, 0
+        if order == 0:
+            balance += row[7]
+            yield (policy_id, row[3], u'Invoice', row_id, None, event_date,
+                   row[4], row[5], bool(row[6]), None, row[7], balance)
+        else:
+            balance -= row[5]
+            yield (policy_id, row[3], u'Payment', None, row_id, event_date,
+                   None, None, None, row[4], -row[5], balance)
+
+
+def format_csv(rows):
+    """Yields the header and then a string of CSV lines per batch of rows."""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    batch = 0
+    for row in rows:
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                         for value in row])
+        batch += 1
+        if batch == EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            batch = 0
+    yield buffer.getvalue()
+
+
+def format_ndjson(rows):
+    """Yields a string of JSON lines per batch of rows."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(EXPORT_COLUMNS,
+                                         [value.isoformat() if hasattr(value, 'isoformat')
+                                          else value for value in row]))))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def gzipped(chunks):
+    """Compresses a stream of strings into a stream of gzip data."""
+    # 16 + MAX_WBITS writes the gzip header and trailer instead of zlib's
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_export(file_format="csv", gzip=False, as_of=None, session=None):
+    """Yields the export of the whole book as strings, ready to be written
+    out in order.
+
+    file_format -- "csv" or "ndjson"
+    gzip -- compress the output (default False)
+    as_of -- Date object, leaves out later rows (defaults to no limit)
+    session -- session to read with (defaults to db.read_session)
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %s" % file_format)
+    formatter = format_csv if file_format == "csv" else format_ndjson
+    chunks = formatter(iter_export_rows(as_of, session))
+    if gzip:
+        chunks = gzipped(chunks)
+    return chunks
+
+
+def export_book(export_file, file_format="csv", gzip=False, as_of=None):
+    """Writes the export to an open file and returns the bytes written.
+
+    export_file -- file object to write to
+    file_format -- "csv" or "ndjson"
+    gzip -- compress the output (default False)
+    as_of -- Date object, leaves out later rows (defaults to no limit)
+    """
+    written = 0
+    for chunk in iter_export(file_format, gzip, as_of):
+        export_file.write(chunk)
+        written += len(chunk)
+    db.read_session.remove()
+    return written
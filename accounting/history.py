@@ -0,0 +1,105 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+
+from sqlalchemy import func, select, tuple_
+
+from accounting import db, settings
+from models import Contact, Invoice, Payment
+
+"""
+#######################################################
+Pages of a policy's invoice and payment history.
+
+Pages are keyset paginated: rows come in date and id
+order, and each page starts after the cursor (date and
+id) of the last row on the one before. Any page is one
+range scan of the policy/date index, however far into
+the history it is. history_totals counts and sums all
+of a policy's rows in the db with one aggregate over
+the same index, without loading them.
+#######################################################
+"""
+
+invoices_table = Invoice.__table__
+payments_table = Payment.__table__
+contacts_table = Contact.__table__
+
+# rows per page on the policy view, and the most the API hands out at once
+HISTORY_PAGE_SIZE = settings.get('HISTORY_PAGE_SIZE', 50)
+MAX_HISTORY_PAGE_SIZE = 500
+
+
+def encode_cursor(row_date, row_id):
+    """Returns the cursor for the page after the (date, id) row."""
+    return "%s.%d" % (row_date.isoformat(), row_id)
+
+
+def decode_cursor(cursor):
+    """Returns the (date, id) of a cursor, raising ValueError for a bad one."""
+    row_date, row_id = cursor.split(".")
+    return datetime.strptime(row_date, "%Y-%m-%d").date(), int(row_id)
+
+
+def keyset_page(query, after=None, limit=HISTORY_PAGE_SIZE, session=None):
+    """Returns (rows, cursor of the next page or None) for a select whose
+    first two columns are the date and id it is ordered by.
+
+    after -- cursor of the previous page (defaults to the first page)
+    limit -- rows on the page
+    session -- session to read with (defaults to db.session)
+    """
+    date_column, id_column = list(query.inner_columns)[:2]
+    if after:
+        query = query.where(tuple_(date_column, id_column) > tuple_(*decode_cursor(after)))
+    rows = (session or db.session).execute(query.order_by(date_column, id_column)
+                                                .limit(limit + 1)).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][0], rows[-1][1])
+
+
+def history_totals(policy_id, kind, session=None):
+    """Returns (count, sum) of all the policy's invoices or payments.
+
+    kind -- "invoices" (sums amount_due) or "payments" (sums amount_paid)
+    session -- session to read with (defaults to db.session)
+    """
+    if kind == 'invoices':
+        table, amount = invoices_table, invoices_table.c.amount_due
+    else:
+        table, amount = payments_table, payments_table.c.amount_paid
+    count, total = (session or db.session).execute(
+        select([func.count(), func.coalesce(func.sum(amount), 0)])
+        .where(table.c.policy_id == policy_id)).first()
+    return count, total
+
+
+def invoice_page(policy_id, after=None, limit=HISTORY_PAGE_SIZE, session=None):
+    """Returns (invoices, next cursor) ordered by bill_date and id, see
+    keyset_page.
+    """
+    return keyset_page(select([invoices_table.c.bill_date,
+                               invoices_table.c.id,
+                               invoices_table.c.due_date,
+                               invoices_table.c.cancel_date,
+                               invoices_table.c.amount_due,
+                               invoices_table.c.deleted])
+                       .where(invoices_table.c.policy_id == policy_id),
+                       after, limit, session)
+
+
+def payment_page(policy_id, after=None, limit=HISTORY_PAGE_SIZE, session=None):
+    """Returns (payments with their contact's name, next cursor) ordered by
+    transaction_date and id, see keyset_page.
+    """
+    return keyset_page(select([payments_table.c.transaction_date,
+                               payments_table.c.id,
+                               payments_table.c.amount_paid,
+                               payments_table.c.contact_id,
+                               contacts_table.c.name.label('contact')])
+                       .select_from(payments_table.outerjoin(
+                           contacts_table, contacts_table.c.id == payments_table.c.contact_id))
+                       .where(payments_table.c.policy_id == policy_id),
+                       after, limit, session)
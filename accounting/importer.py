@@ -0,0 +1,262 @@
+#!/user/bin/env python2.7
+
+import csv
+import hashlib
+import json
+import time
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import select
+
+from accounting import db
+from ledger import rebuild_entries
+from logger import Logger
+from models import Contact, Payment, Policy
+from timeline import PolicyTimeline, chunked, iter_timelines
+from tools import logger
+
+"""
+#######################################################
+Bulk payment import from lockbox and ACH files.
+
+Payments are streamed from a CSV or NDJSON file and
+posted a chunk at a time: the same checks as
+make_payment (known contact, no payments from
+non-agents on a policy in cancel pending) are made
+against one timeline per policy in the chunk, and each
+chunk's rows and ledger entries are committed
+together. Every payment carries an idempotency key, so
+posting a file again skips what is already in.
+
+Rows need policy_id, amount_paid and transaction_date
+(YYYY-MM-DD). contact_id defaults to the policy's named
+insured and idempotency_key to a hash of the row, its
+line number and the file's contents.
+#######################################################
+"""
+
+payments_table = Payment.__table__
+policies_table = Policy.__table__
+contacts_table = Contact.__table__
+
+# payments posted per transaction
+IMPORT_CHUNK_SIZE = 5000
+
+# rejected rows reported back in detail, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+# bytes read at a time while hashing a payment file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def read_payments(payment_file, file_format=None):
+    """Yields (line number, row dict) for each payment in an open file. NDJSON
+    lines that are not a JSON object come back with None for the row.
+
+    payment_file -- file object to read
+    file_format -- "csv" or "ndjson" (defaults to guessing from the name)
+    """
+    if file_format is None:
+        name = getattr(payment_file, 'name', '')
+        file_format = "ndjson" if name.endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+    if file_format == "csv":
+        # the header is line 1
+        for line_number, row in enumerate(csv.DictReader(payment_file), 2):
+            yield line_number, row
+    elif file_format == "ndjson":
+        for line_number, line in enumerate(payment_file, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield line_number, row if isinstance(row, dict) else None
+    else:
+        raise ValueError("Unknown payment file format: %s" % file_format)
+
+
+def file_digest(payment_file):
+    """Returns a sha1 of what is left of payment_file, leaving it where it was."""
+    start = payment_file.tell()
+    digest = hashlib.sha1()
+    for block in iter(lambda: payment_file.read(HASH_BLOCK_SIZE), ""):
+        digest.update(block)
+    payment_file.seek(start)
+    return digest.hexdigest()
+
+
+def row_key(source, line_number, row):
+    """Returns the row's idempotency key. Rows without one are keyed by a
+    hash of their fields, line and source, so identical rows in a file or
+    on the same line of two files all post but the same file posted twice
+    does not.
+
+    source -- identifies the file the row came from
+    """
+    if row.get('idempotency_key'):
+        return unicode(row['idempotency_key'])
+    digest = hashlib.sha1("|".join([unicode(source)] +
+                                   [unicode(row.get(field) or '') for field in
+                                    ('policy_id', 'contact_id', 'amount_paid',
+                                     'transaction_date')])).hexdigest()
+    return u"%s-%d" % (digest, line_number)
+
+
+def parse_int(value):
+    """Returns value as an int, raising ValueError for a fraction int() would
+    truncate.
+    """
+    number = int(value)
+    if number != value and not isinstance(value, basestring):
+        raise ValueError("Not a whole number: %r" % value)
+    return number
+
+
+def parse_row(row):
+    """Returns (policy_id, contact_id, amount_paid, transaction_date),
+    raising ValueError for a bad row.
+    """
+    try:
+        policy_id = parse_int(row['policy_id'])
+        contact_id = parse_int(row['contact_id']) if row.get('contact_id') else None
+        amount_paid = parse_int(row['amount_paid'])
+        transaction_date = datetime.strptime(row['transaction_date'], "%Y-%m-%d").date()
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Malformed row")
+    if amount_paid <= 0:
+        raise ValueError("Payment amount must be positive")
+    return policy_id, contact_id, amount_paid, transaction_date
+
+
+def existing_keys(keys):
+    """Returns the idempotency keys already posted."""
+    found = set()
+    for key_group in chunked(keys):
+        found.update(row[0] for row in db.session.execute(
+            select([payments_table.c.idempotency_key])
+            .where(payments_table.c.idempotency_key.in_(key_group))))
+    return found
+
+
+def reject(stats, line_number, reason):
+    stats['rejected'] += 1
+    stats['reasons'][reason] += 1
+    if len(stats['errors']) < MAX_REPORTED_ERRORS:
+        stats['errors'].append({'line': line_number, 'error': reason})
+
+
+def post_chunk(rows, contact_roles, stats, source):
+    """Validates and posts one chunk of (line number, row) pairs.
+
+    contact_roles -- {contact_id: role} for every contact
+    stats -- counters updated in place
+    source -- identifies the file, see row_key
+    """
+    keyed = []
+    for line_number, row in rows:
+        if row is None:
+            reject(stats, line_number, "Malformed row")
+        else:
+            keyed.append((line_number, row, row_key(source, line_number, row)))
+    posted_keys = existing_keys([key for line_number, row, key in keyed])
+
+    parsed = []
+    for line_number, row, key in keyed:
+        if key in posted_keys:
+            stats['duplicates'] += 1
+            continue
+        posted_keys.add(key)
+        try:
+            parsed.append((line_number, key) + parse_row(row))
+        except ValueError, e:
+            reject(stats, line_number, str(e))
+
+    policy_ids = sorted(set(payment[2] for payment in parsed))
+    named_insureds = {}
+    for id_group in chunked(policy_ids):
+        named_insureds.update(db.session.execute(
+            select([policies_table.c.id, policies_table.c.named_insured])
+            .where(policies_table.c.id.in_(id_group))).fetchall())
+    timelines = dict((timeline.policy_id, timeline) for timeline in
+                     iter_timelines(policy_ids=[policy_id for policy_id in policy_ids
+                                                if policy_id in named_insureds]))
+
+    inserts = []
+    cancel_pending = []
+    for line_number, key, policy_id, contact_id, amount_paid, transaction_date in parsed:
+        if policy_id not in named_insureds:
+            reject(stats, line_number, Logger.error_msgs[1])
+            continue
+        if contact_id is None:
+            contact_id = named_insureds[policy_id]
+        if contact_id not in contact_roles:
+            reject(stats, line_number, "Unknown contact_id")
+            continue
+
+        timeline = timelines.get(policy_id) or PolicyTimeline(policy_id)
+        if contact_roles[contact_id] != "Agent" and timeline.cancel_pending(transaction_date):
+            reject(stats, line_number, Logger.error_msgs[2])
+            cancel_pending.append(policy_id)
+            continue
+
+        inserts.append({'policy_id': policy_id,
+                        'contact_id': contact_id,
+                        'amount_paid': amount_paid,
+                        'transaction_date': transaction_date,
+                        'idempotency_key': key})
+        # later rows in the chunk see this payment, like separate make_payment calls
+        timelines[policy_id] = PolicyTimeline(policy_id, timeline.invoices,
+                                              sorted(timeline.payments +
+                                                     [(transaction_date, amount_paid, None)]))
+        stats['amount'] += amount_paid
+
+    if inserts:
+        db.session.execute(payments_table.insert(), inserts)
+        # replaying the ledger commits the chunk
+        rebuild_entries(sorted(set(payment['policy_id'] for payment in inserts)))
+    else:
+        db.session.commit()
+    logger.log_many(Logger.error_msgs[2], "Error", cancel_pending)
+    stats['imported'] += len(inserts)
+
+
+def import_payments(payment_file, file_format=None, chunk_size=IMPORT_CHUNK_SIZE, source=None):
+    """Posts every payment in payment_file and returns what happened to them.
+
+    Only a chunk of rows is held at a time. Rows already posted by an
+    earlier import, matched on idempotency key, are skipped.
+
+    payment_file -- open CSV or NDJSON file
+    file_format -- "csv" or "ndjson" (defaults to guessing from the name)
+    chunk_size -- payments posted per transaction
+    source -- identifies the file in the keys of rows without an
+              idempotency_key (defaults to a hash of the file's contents,
+              which needs a file that can seek)
+    """
+    started = time.time()
+    if source is None:
+        try:
+            source = file_digest(payment_file)
+        except IOError:
+            raise ValueError("Payment file can't be hashed, give it a source")
+    contact_roles = dict(db.session.execute(select([contacts_table.c.id,
+                                                    contacts_table.c.role])).fetchall())
+    stats = {'read': 0, 'imported': 0, 'duplicates': 0, 'rejected': 0, 'amount': 0,
+             'reasons': Counter(), 'errors': []}
+
+    rows = read_payments(payment_file, file_format)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        stats['read'] += len(chunk)
+        post_chunk(chunk, contact_roles, stats, source)
+
+    stats['reasons'] = dict(stats['reasons'])
+    stats['seconds'] = time.time() - started
+    print "Imported %(imported)s of %(read)s payments (%(duplicates)s duplicates, " \
+          "%(rejected)s rejected) in %(seconds).2fs" % stats
+    return stats
@@ -0,0 +1,86 @@
+#!/user/bin/env python2.7
+
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+#######################################################
+Hooks for watching the SQL the accounting code runs.
+#######################################################
+"""
+
+# QueryRecorders currently collecting statements
+_recorders = []
+
+
+def _listening_recorders():
+    """Returns the recorders that see statements run on this thread."""
+    thread = threading.current_thread()
+    return [recorder for recorder in _recorders
+            if recorder.thread is None or recorder.thread is thread]
+
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    if _recorders:
+        for recorder in _listening_recorders():
+            recorder.statements.append((statement, parameters))
+            recorder.durations.append(None)
+        conn.info['statement_started'] = time.time()
+
+
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    if _recorders:
+        finished = time.time()
+        elapsed = finished - conn.info.pop('statement_started', finished)
+        for recorder in _listening_recorders():
+            if recorder.durations and recorder.durations[-1] is None:
+                recorder.durations[-1] = elapsed
+
+# connections opened before this import are not seen, so import it early
+event.listen(Engine, 'before_cursor_execute', _record_statement)
+event.listen(Engine, 'after_cursor_execute', _time_statement)
+
+
+class QueryRecorder(object):
+    """
+     Collects every statement run on the engine inside a with block.
+    """
+    def __init__(self, current_thread_only=False):
+        """Creates an empty recorder.
+
+        current_thread_only -- ignore statements other threads run
+        """
+        self.statements = []
+        # seconds each statement took, None until it finishes
+        self.durations = []
+        self.thread = threading.current_thread() if current_thread_only else None
+
+    def __enter__(self):
+        _recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _recorders.remove(self)
+
+    @property
+    def count(self):
+        """Number of statements run so far."""
+        return len(self.statements)
+
+    def selects(self):
+        """Returns the recorded (statement, parameters) that read rows."""
+        return [(statement, parameters) for statement, parameters in self.statements
+                if statement.lstrip().upper().startswith('SELECT')]
+
+    @property
+    def total_time(self):
+        """Seconds spent running the recorded statements."""
+        return sum(duration for duration in self.durations if duration)
+
+    def slowest(self, count=5):
+        """Returns the count slowest (seconds, statement) pairs, slowest first."""
+        timed = [(duration, statement) for (statement, parameters), duration in
+                 zip(self.statements, self.durations) if duration is not None]
+        return sorted(timed, reverse=True)[:count]
@@ -0,0 +1,163 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+from itertools import groupby
+
+from sqlalchemy import func, select
+
+from accounting import db
+from models import LedgerEntry
+from timeline import chunked, invalidate_timelines, iter_timelines, policy_filters
+
+"""
+#######################################################
+Ledger of invoices and payments with running balances.
+
+Each entry keeps the policy's balance as of its own
+entry_date, so the balance at any date is the latest
+entry on or before it. The ledger is not append-only:
+an entry dated before existing ones updates their
+stored balances, and rebuild_entries replaces a
+policy's entries with ones replayed from the invoices
+and payments tables. Hard deleted invoices are written
+off with a Reversal entry on their bill_date, which a
+rebuild drops along with the invoice.
+#######################################################
+"""
+
+ledger_table = LedgerEntry.__table__
+
+# rows per executemany when rebuilding
+INSERT_CHUNK_SIZE = 10000
+
+
+def ledger_balance(policy_id, date_cursor=None):
+    """Returns the policy's balance from the ledger.
+
+    policy_id -- Primary key of policies table
+    date_cursor -- Date object (defaults to current date)
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    row = db.session.execute(
+        select([ledger_table.c.balance])
+        .where(ledger_table.c.policy_id == policy_id)
+        .where(ledger_table.c.entry_date <= date_cursor)
+        .order_by(ledger_table.c.entry_date.desc(), ledger_table.c.id.desc())
+        .limit(1)).first()
+    if row is None:
+        return 0
+    return row[0]
+
+
+def ledger_version(policy_id, session=None):
+    """Returns the id of the policy's last ledger entry. Every write adds
+    entries, and ledger ids are AUTOINCREMENT so even the entries a
+    rebuild puts back get ids higher than any before: it moves whenever
+    the policy's invoices or payments do.
+
+    policy_id -- Primary key of policies table
+    session -- session to read with (defaults to db.session)
+    """
+    return (session or db.session).execute(
+        select([func.max(ledger_table.c.id)])
+        .where(ledger_table.c.policy_id == policy_id)).scalar()
+
+
+def append_entries(policy_id, entries):
+    """Inserts entries into a policy's ledger without committing.
+
+    Entries dated before existing ones update the stored balance of every
+    later entry, so balances stay correct however the rows arrive.
+
+    policy_id -- Primary key of policies table
+    entries -- (entry_date, kind, amount, invoice_id, payment_id) tuples
+    """
+    for entry_date, kind, amount, invoice_id, payment_id in \
+            sorted(entries, key=lambda entry: entry[0]):
+        balance = ledger_balance(policy_id, entry_date) + amount
+        db.session.execute(ledger_table.update()
+                           .where(ledger_table.c.policy_id == policy_id)
+                           .where(ledger_table.c.entry_date > entry_date)
+                           .values(balance=ledger_table.c.balance + amount))
+        db.session.execute(ledger_table.insert()
+                           .values(policy_id=policy_id,
+                                   entry_date=entry_date,
+                                   kind=kind,
+                                   amount=amount,
+                                   balance=balance,
+                                   invoice_id=invoice_id,
+                                   payment_id=payment_id))
+
+
+def record_invoices(invoices):
+    """Adds ledger entries for newly flushed invoices."""
+    for policy_id, group in groupby(sorted(invoices, key=lambda invoice: invoice.policy_id),
+                                    lambda invoice: invoice.policy_id):
+        append_entries(policy_id, [(invoice.bill_date, u'Invoice', invoice.amount_due,
+                                    invoice.id, None) for invoice in group])
+
+
+def record_reversals(invoices):
+    """Writes off hard deleted invoices from the ledger."""
+    for policy_id, group in groupby(sorted(invoices, key=lambda invoice: invoice.policy_id),
+                                    lambda invoice: invoice.policy_id):
+        append_entries(policy_id, [(invoice.bill_date, u'Reversal', -invoice.amount_due,
+                                    invoice.id, None) for invoice in group])
+
+
+def record_payment(payment):
+    """Adds the ledger entry for a newly flushed payment."""
+    append_entries(payment.policy_id, [(payment.transaction_date, u'Payment',
+                                        -payment.amount_paid, None, payment.id)])
+
+
+def rebuild_entries(policy_ids=None, session=None):
+    """Regenerates ledger entries from the invoices and payments tables.
+
+    Reversals are not replayed since hard deleted invoices are already gone
+    from the raw rows. Commits once at the end and returns the number of
+    policies replayed.
+
+    policy_ids -- only rebuild these policies (defaults to the whole book)
+    session -- session to read, write and commit with (defaults to db.session)
+    """
+    session = session or db.session
+    if policy_ids is None:
+        session.execute(ledger_table.delete())
+    else:
+        for id_group in chunked(policy_ids):
+            delete = ledger_table.delete()
+            for clause in policy_filters(ledger_table.c.policy_id, id_group):
+                delete = delete.where(clause)
+            session.execute(delete)
+
+    rebuilt = 0
+    rows = []
+    for timeline in iter_timelines(policy_ids=policy_ids, session=session):
+        rebuilt += 1
+        events = [(invoice[0], 0, u'Invoice', invoice[3], invoice[4], None)
+                  for invoice in timeline.invoices]
+        events.extend((payment[0], 1, u'Payment', -payment[1], None, payment[2])
+                      for payment in timeline.payments)
+        balance = 0
+        for entry_date, order, kind, amount, invoice_id, payment_id in sorted(events):
+            balance += amount
+            rows.append({'policy_id': timeline.policy_id,
+                         'entry_date': entry_date,
+                         'kind': kind,
+                         'amount': amount,
+                         'balance': balance,
+                         'invoice_id': invoice_id,
+                         'payment_id': payment_id})
+        if len(rows) >= INSERT_CHUNK_SIZE:
+            session.execute(ledger_table.insert(), rows)
+            rows = []
+
+    if rows:
+        session.execute(ledger_table.insert(), rows)
+    session.commit()
+    # the bulk writers that call this bypass the session's flush events
+    invalidate_timelines(policy_ids)
+    return rebuilt
@@ -3,37 +3,79 @@
 # This all could be replaced by logger but this lightweight option
 # seemed more controllable.
 
+import atexit
+import threading
 from datetime import datetime
+from Queue import Empty, Full, Queue
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from logstore import LogStore
+
 class Logger(object):
     """Logger class handles all writing to log files."""
     error_msgs = {
                    0: "A problem has occurred.",
                    1: "Policy Accounting was given an unknown policy_id",
-                   2: "Payment attempt made on a policy in cancel pending"
-                 } 
+                   2: "Payment attempt made on a policy in cancel pending",
+                   3: "Write attempted through a read only PolicyAccounting"
+                 }
 
     _instance = None
 
-    def __init__(self):
-        """Creates a logger class."""
+    def __init__(self, queued=False, log_dir="Logs", max_segment_size=64 * 1024 * 1024,
+                 **queue_options):
+        """Creates a logger class.
+
+        queued -- write from a background thread instead of the caller's
+        log_dir -- directory the log segments live in
+        max_segment_size -- bytes per segment before rotating to a new one
+        queue_options -- passed on to QueuedLogWriter
+        """
         self.active = True
         self.pw_hash = generate_password_hash("iws") # just trying to keep out most normal users
-        
+        self.store = LogStore(log_dir, max_segment_size)
+        self.writer = None
+        if queued:
+            self.start_queue(**queue_options)
+
 
-        
     def __call__(self):
         """Should make logger a singleton class"""
         return self
 
 
+    def format_record(self, error_msg, level, policy_id):
+        """Returns the text written to the log for one message."""
+        return "[%s] %s Policy ID: %s\n%s\n" % (level, str(datetime.now()), policy_id,
+                                                error_msg)
+
+
     def log(self, error_msg, level = "Debug", policy_id = "X"):
         """Logs the error message with level and policy_id"""
         if self.active:
-            with open("Logs/policy_id_" + str(policy_id) + ".log", 'a') as inp:
-                inp.write("[%s] %s Policy ID: %s\n" % (level, str(datetime.now()), policy_id ))
-                inp.write(error_msg + "\n")
+            record = self.format_record(error_msg, level, policy_id)
+            if self.writer:
+                self.writer.put(policy_id, record)
+            else:
+                self.store.append(policy_id, record)
+
+
+    def log_many(self, error_msg, level = "Debug", policy_ids = ()):
+        """Logs the same message for many policies with one write."""
+        if self.active:
+            records = [(policy_id, self.format_record(error_msg, level, policy_id))
+                       for policy_id in policy_ids]
+            if self.writer:
+                for policy_id, record in records:
+                    self.writer.put(policy_id, record)
+            elif records:
+                self.store.append_batch(records)
+
+
+    def read_log(self, policy_id):
+        """Returns the records logged for policy_id, oldest first."""
+        self.flush()
+        return self.store.read(policy_id)
 
 
     def log_error(self, error_num = 0, policy_id = "X"):
@@ -57,15 +99,123 @@ class Logger(object):
         """Turn logger off so it will not write to logs."""
         active = False
 
-    
+
+    def set_log_dir(self, log_dir):
+        """Writes everything so far and moves on to the segments in log_dir."""
+        self.flush()
+        self.store.close()
+        self.store = LogStore(log_dir, self.store.max_segment_size)
+        if self.writer:
+            self.writer.store = self.store
+
+
+    def start_queue(self, **queue_options):
+        """Switch to writing logs from a background thread."""
+        if not self.writer:
+            self.writer = QueuedLogWriter(self.store, **queue_options)
+
+
+    def stop_queue(self):
+        """Write out anything queued and go back to writing synchronously."""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+
+    def flush(self):
+        """Blocks until every queued record is on disk."""
+        if self.writer:
+            self.writer.flush()
+
+
     def clear_logs(self, password):
         """Clears all logs in logs file"""
         if check_password_hash(self.pw_hash, password):
-            import os
-            for the_file in os.listdir("Logs"):
-                file_path = os.path.join("Logs", the_file)
+            self.flush()
+            try:
+                self.store.clear()
+            except Exception, e:
+                print e
+
+
+class QueuedLogWriter(object):
+    """
+     Drains log records from a bounded queue on a daemon thread, writing
+     them to the LogStore in batches.
+    """
+    def __init__(self, store, max_queue_size=10000, batch_size=500, overflow="block"):
+        """Starts the writer thread.
+
+        store -- LogStore the records end up in
+        max_queue_size -- records held before overflow kicks in
+        batch_size -- most records written at once
+        overflow -- "block" waits for room in the queue, "drop" discards
+                    the record and counts it in dropped
+        Batches the store fails to write are counted in failed and the
+        thread carries on with the next one.
+        """
+        if overflow not in ("block", "drop"):
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+
+        self.store = store
+        self.queue = Queue(max_queue_size)
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.dropped = 0
+        self.failed = 0
+
+        self.thread = threading.Thread(target=self.drain, name="QueuedLogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+        # write out what is left when the interpreter shuts down
+        atexit.register(self.close)
+
+    def put(self, policy_id, record):
+        """Queues record for policy_id's log, writing it straight to the
+        store once the writer thread has stopped.
+        """
+        if not self.thread.is_alive():
+            self.store.append(policy_id, record)
+        elif self.overflow == "block":
+            self.queue.put((policy_id, record))
+        else:
+            try:
+                self.queue.put_nowait((policy_id, record))
+            except Full:
+                self.dropped += 1
+
+    def drain(self):
+        """Writer thread loop, None on the queue stops it."""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
                 try:
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                except Exception, e:
-                    print e
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            stop = None in batch
+            records = [item for item in batch if item is not None]
+            try:
+                if records:
+                    self.store.append_batch(records)
+            except Exception, e:
+                # keep draining, a dead thread would leave put blocked forever
+                self.failed += len(records)
+                print "Log write failed, %d records lost: %s" % (len(records), e)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """Blocks until every queued record is written."""
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Writes out the queue and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
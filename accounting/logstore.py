@@ -0,0 +1,225 @@
+#!/user/bin/env python2.7
+
+import fcntl
+import os
+import threading
+from array import array
+
+"""
+#######################################################
+Segmented append-only store for every policy's log.
+
+Records go to the active segment_<n>.log file and a
+"policy_id offset length" line goes to the matching
+segment_<n>.idx file, so one policy's history is read
+with a few seeks instead of a scan. Writers from any
+number of processes share a log_dir: each batch holds
+an flock on the segment and takes its offsets from the
+file's size, and readers pick up what other processes
+added to an idx file since they last looked. compact
+should only run while nothing else is writing.
+#######################################################
+"""
+
+
+class LogStore(object):
+    """
+     All policy log records, split across numbered segment files.
+    """
+    def __init__(self, log_dir="Logs", max_segment_size=64 * 1024 * 1024):
+        """Creates a store over log_dir, nothing is opened until first use.
+
+        log_dir -- directory holding the segment and index files
+        max_segment_size -- bytes written before rotating to a new segment
+        """
+        self.log_dir = log_dir
+        self.max_segment_size = max_segment_size
+        self.lock = threading.RLock()
+        # segment number -> {policy_id: array of offset, length pairs}
+        self.indexes = {}
+        # segment number -> (inode, bytes) of its idx file read into indexes
+        self.index_positions = {}
+        # (number, log file, index file) for the segment being written
+        self.active = None
+
+    def segment_path(self, number, extension="log"):
+        """Returns the path of segment number's log or idx file."""
+        return os.path.join(self.log_dir, "segment_%08d.%s" % (number, extension))
+
+    def segment_numbers(self):
+        """Returns the numbers of the segments on disk, oldest first."""
+        if not os.path.isdir(self.log_dir):
+            return []
+        return sorted(int(name[len("segment_"):-len(".log")])
+                      for name in os.listdir(self.log_dir)
+                      if name.startswith("segment_") and name.endswith(".log"))
+
+    def index_for(self, number):
+        """Returns segment number's index, reading whatever was added to its
+        idx file since the last call.
+        """
+        index_path = self.segment_path(number, "idx")
+        if not os.path.exists(index_path):
+            return self.indexes.get(number, {})
+        stat = os.stat(index_path)
+        inode, position = self.index_positions.get(number, (None, 0))
+        index = self.indexes.get(number)
+        if index is None or stat.st_ino != inode or stat.st_size < position:
+            # new to this store, or replaced by a compact
+            index, position = {}, 0
+        if stat.st_size > position:
+            with open(index_path, 'rb') as index_file:
+                index_file.seek(position)
+                lines = index_file.read(stat.st_size - position)
+            # another process may be part way through writing its last line
+            lines = lines[:lines.rfind("\n") + 1]
+            for line in lines.splitlines():
+                policy_id, offset, length = line.split()
+                index.setdefault(policy_id, array('L')).extend((int(offset), int(length)))
+            position += len(lines)
+        self.indexes[number] = index
+        self.index_positions[number] = (stat.st_ino, position)
+        return index
+
+    def active_segment(self):
+        """Returns the segment being written, opening or rotating as needed."""
+        if self.active is None:
+            if not os.path.isdir(self.log_dir):
+                os.makedirs(self.log_dir)
+            numbers = self.segment_numbers()
+            number = numbers[-1] if numbers else 1
+            if numbers and os.path.getsize(self.segment_path(number)) >= self.max_segment_size:
+                number += 1
+            log_file = open(self.segment_path(number), 'ab')
+            log_file.seek(0, os.SEEK_END)
+            self.active = (number, log_file, open(self.segment_path(number, "idx"), 'ab'))
+        return self.active
+
+    def rotate(self):
+        """Closes the active segment so the next record starts a new one."""
+        with self.lock:
+            if self.active is not None:
+                number = self.active[0]
+                self.close()
+                if os.path.getsize(self.segment_path(number)) < self.max_segment_size:
+                    # start the next segment now so active_segment picks it up
+                    with open(self.segment_path(number + 1), 'ab'):
+                        pass
+
+    def close(self):
+        """Closes the active segment's files, they reopen on the next write."""
+        with self.lock:
+            if self.active is not None:
+                self.active[1].close()
+                self.active[2].close()
+                self.active = None
+
+    def append(self, policy_id, record):
+        """Adds one record to policy_id's log."""
+        self.append_batch([(policy_id, record)])
+
+    def append_batch(self, batch):
+        """Adds (policy_id, record) pairs with one write per file."""
+        records = []
+        for policy_id, record in batch:
+            if isinstance(record, unicode):
+                record = record.encode("utf-8")
+            records.append((str(policy_id), record))
+
+        with self.lock:
+            while True:
+                number, log_file, index_file = self.active_segment()
+                fcntl.flock(log_file.fileno(), fcntl.LOCK_EX)
+                # the file's size, not our own position, since other
+                # processes append to the same segment
+                offset = os.fstat(log_file.fileno()).st_size
+                if offset < self.max_segment_size:
+                    break
+                # another process filled the segment first
+                fcntl.flock(log_file.fileno(), fcntl.LOCK_UN)
+                self.rotate()
+
+            try:
+                index_lines = []
+                for policy_id, record in records:
+                    index_lines.append("%s %d %d\n" % (policy_id, offset, len(record)))
+                    offset += len(record)
+                log_file.write("".join(record for policy_id, record in records))
+                log_file.flush()
+                index_file.write("".join(index_lines))
+                index_file.flush()
+            finally:
+                fcntl.flock(log_file.fileno(), fcntl.LOCK_UN)
+            if offset >= self.max_segment_size:
+                self.rotate()
+
+    def read(self, policy_id):
+        """Returns every record logged for policy_id, oldest first."""
+        policy_id = str(policy_id)
+        records = []
+        with self.lock:
+            for number in self.segment_numbers():
+                ranges = self.index_for(number).get(policy_id)
+                if not ranges:
+                    continue
+                with open(self.segment_path(number), 'rb') as log_file:
+                    for i in range(0, len(ranges), 2):
+                        log_file.seek(ranges[i])
+                        records.append(log_file.read(ranges[i + 1]))
+        return records
+
+    def compact(self):
+        """Merges every closed segment into one with each policy's records
+        stored together. The active segment is left alone.
+        """
+        with self.lock:
+            numbers = self.segment_numbers()
+            if self.active is not None:
+                numbers.remove(self.active[0])
+            if len(numbers) < 2:
+                return
+
+            policy_ids = set()
+            for number in numbers:
+                policy_ids.update(self.index_for(number))
+
+            target = numbers[0]
+            with open(self.segment_path(target) + ".compact", 'wb') as log_file:
+                with open(self.segment_path(target, "idx") + ".compact", 'wb') as index_file:
+                    for policy_id in sorted(policy_ids):
+                        for number in numbers:
+                            ranges = self.index_for(number).get(policy_id)
+                            if not ranges:
+                                continue
+                            with open(self.segment_path(number), 'rb') as segment:
+                                for i in range(0, len(ranges), 2):
+                                    segment.seek(ranges[i])
+                                    record = segment.read(ranges[i + 1])
+                                    index_file.write("%s %d %d\n" % (policy_id,
+                                                                     log_file.tell(),
+                                                                     len(record)))
+                                    log_file.write(record)
+
+            # the renames replace the oldest segment, then the rest are dropped
+            os.rename(self.segment_path(target, "idx") + ".compact",
+                      self.segment_path(target, "idx"))
+            os.rename(self.segment_path(target) + ".compact", self.segment_path(target))
+            for number in numbers[1:]:
+                self.drop_segment(number)
+            self.indexes.pop(target, None)
+            self.index_positions.pop(target, None)
+
+    def drop_segment(self, number):
+        """Deletes segment number's log and idx files."""
+        for extension in ("log", "idx"):
+            if os.path.exists(self.segment_path(number, extension)):
+                os.unlink(self.segment_path(number, extension))
+        self.indexes.pop(number, None)
+        self.index_positions.pop(number, None)
+
+    def clear(self):
+        """Drops every segment."""
+        with self.lock:
+            self.close()
+            for number in self.segment_numbers():
+                self.drop_segment(number)
@@ -0,0 +1,272 @@
+#!/user/bin/env python2.7
+
+import bisect
+import heapq
+import signal
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import g, jsonify, request
+
+from contacts import contact_name_cache
+from instrumentation import QueryRecorder
+from timeline import page_cache, timeline_cache
+from tools import PolicyAccounting
+
+"""
+#######################################################
+Per request SQL and timing metrics for the Flask app.
+
+With METRICS_ENABLED each response carries its query
+count, SQL time, slowest statements and the time spent
+in PolicyAccounting methods as X- headers, and /metrics
+serves histograms aggregated over every request. With
+it off the only cost is one config lookup per request.
+
+METRICS_PROFILE also samples the request thread's
+stack, which only works when requests are served on
+the main thread (the default for runserver.py).
+#######################################################
+"""
+
+# upper bounds of the histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+TIMED_METHODS = ('__init__', 'return_account_balance',
+                 'evaluate_cancellation_pending_due_to_non_pay', 'evaluate_status',
+                 'evaluate_cancel', 'make_payment', 'make_invoices', 'change_billing_schedule')
+
+# the RequestMetrics of the request being served on each thread
+_active = threading.local()
+
+
+def timed(method):
+    """Wraps method so its time is added to the current request's metrics."""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        metrics = getattr(_active, 'metrics', None)
+        if metrics is None:
+            return method(*args, **kwargs)
+        started = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            metrics.add_method_time(method.__name__, time.time() - started)
+    wrapper.timed = True
+    return wrapper
+
+
+def instrument_methods(cls, names=TIMED_METHODS):
+    """Replaces cls's methods with timed ones, once."""
+    for name in names:
+        method = cls.__dict__[name]
+        if not getattr(method, 'timed', False):
+            setattr(cls, name, timed(method))
+
+
+class SamplingProfiler(object):
+    """
+     Counts the functions on the stack every interval seconds of CPU time.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # "file:function" -> samples it was on the stack for
+        self.samples = Counter()
+        self.running = False
+
+    def sample(self, signum, frame):
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            name = "%s:%s" % (code.co_filename, code.co_name)
+            if name not in seen:
+                seen.add(name)
+                self.samples[name] += 1
+            frame = frame.f_back
+
+    def start(self):
+        """Starts sampling, returns False off the main thread where signals
+        cannot be caught.
+        """
+        if threading.current_thread().name != 'MainThread':
+            return False
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        return True
+
+    def stop(self):
+        if self.running:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+            self.running = False
+
+
+class RequestMetrics(object):
+    """
+     What one request spent its time on.
+    """
+    def __init__(self, profile_interval=None):
+        """Starts recording the current thread's statements.
+
+        profile_interval -- seconds between stack samples (defaults to no
+                            profiling)
+        """
+        self.recorder = QueryRecorder(current_thread_only=True).__enter__()
+        # method name -> [calls, seconds], nested calls count toward both
+        self.method_times = {}
+        self.profiler = None
+        if profile_interval:
+            self.profiler = SamplingProfiler(profile_interval)
+            self.profiler.start()
+        self.started = time.time()
+        self.elapsed = None
+
+    def add_method_time(self, name, seconds):
+        totals = self.method_times.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def finish(self):
+        """Stops recording."""
+        self.elapsed = time.time() - self.started
+        self.recorder.__exit__(None, None, None)
+        if self.profiler:
+            self.profiler.stop()
+
+    def headers(self, slowest_count=5):
+        """Returns the X- headers describing this request."""
+        headers = {
+            'X-Request-Time-Ms': "%.3f" % (self.elapsed * 1000),
+            'X-Query-Count': str(self.recorder.count),
+            'X-SQL-Time-Ms': "%.3f" % (self.recorder.total_time * 1000),
+            'X-Slowest-SQL-Ms': ",".join("%.3f" % (seconds * 1000) for seconds, statement
+                                         in self.recorder.slowest(slowest_count)),
+            'X-PolicyAccounting-Ms': ",".join("%s=%.3f" % (name, totals[1] * 1000)
+                                              for name, totals in
+                                              sorted(self.method_times.items())),
+        }
+        if self.profiler:
+            headers['X-Profile-Top'] = ",".join("%s=%d" % (name.rsplit(':', 1)[-1], count)
+                                                for name, count in
+                                                self.profiler.samples.most_common(5))
+        return headers
+
+
+def histogram(buckets):
+    return [0] * (len(buckets) + 1)
+
+
+class MetricsRegistry(object):
+    """
+     Histograms of every instrumented request, grouped by endpoint.
+    """
+    def __init__(self, slowest_count=5):
+        self.slowest_count = slowest_count
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            # min heap of (seconds, statement, endpoint)
+            self.slowest = []
+            self.profile = Counter()
+
+    def observe(self, endpoint, metrics):
+        """Adds a finished request's RequestMetrics."""
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'requests': 0, 'request_ms': 0.0, 'sql_ms': 0.0, 'queries': 0,
+                    'latency_ms': histogram(LATENCY_BUCKETS_MS),
+                    'query_count': histogram(QUERY_BUCKETS),
+                    'methods': {}}
+            request_ms = metrics.elapsed * 1000
+            stats['requests'] += 1
+            stats['request_ms'] += request_ms
+            stats['sql_ms'] += metrics.recorder.total_time * 1000
+            stats['queries'] += metrics.recorder.count
+            stats['latency_ms'][bisect.bisect_left(LATENCY_BUCKETS_MS, request_ms)] += 1
+            stats['query_count'][bisect.bisect_left(QUERY_BUCKETS, metrics.recorder.count)] += 1
+            for name, (calls, seconds) in metrics.method_times.items():
+                totals = stats['methods'].setdefault(name, {'calls': 0, 'ms': 0.0})
+                totals['calls'] += calls
+                totals['ms'] += seconds * 1000
+
+            for seconds, statement in metrics.recorder.slowest(self.slowest_count):
+                entry = (seconds, statement, endpoint)
+                if len(self.slowest) < self.slowest_count:
+                    heapq.heappush(self.slowest, entry)
+                elif entry > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, entry)
+            if metrics.profiler:
+                self.profile.update(metrics.profiler.samples)
+
+    def snapshot(self):
+        """Returns everything observed so far as plain dicts and lists."""
+        with self.lock:
+            return {'latency_buckets_ms': list(LATENCY_BUCKETS_MS),
+                    'query_buckets': list(QUERY_BUCKETS),
+                    'endpoints': dict((endpoint, dict(stats, methods=dict(stats['methods'])))
+                                      for endpoint, stats in self.endpoints.items()),
+                    'slowest_statements': [{'ms': seconds * 1000,
+                                            'statement': statement,
+                                            'endpoint': endpoint}
+                                           for seconds, statement, endpoint
+                                           in sorted(self.slowest, reverse=True)],
+                    'profile': self.profile.most_common(50)}
+
+registry = MetricsRegistry()
+
+
+def start_request_metrics(app):
+    if not app.config.get('METRICS_ENABLED') or request.endpoint == 'metrics':
+        return
+    instrument_methods(PolicyAccounting)
+    profile_interval = None
+    if app.config.get('METRICS_PROFILE'):
+        profile_interval = app.config.get('METRICS_PROFILE_INTERVAL', 0.005)
+    g.request_metrics = _active.metrics = RequestMetrics(profile_interval)
+
+
+def finish_request_metrics(app, response):
+    metrics = getattr(g, 'request_metrics', None)
+    if metrics is None:
+        return response
+    _active.metrics = None
+    metrics.finish()
+    # streamed bodies are generated after this, so only their setup is counted
+    registry.observe(request.endpoint, metrics)
+    for name, value in metrics.headers(app.config.get('METRICS_SLOWEST_STATEMENTS', 5)).items():
+        response.headers[name] = value
+    return response
+
+
+def abandon_request_metrics(exception=None):
+    # after_request is skipped when a view raises
+    metrics = getattr(g, 'request_metrics', None)
+    if metrics is not None and metrics.elapsed is None:
+        _active.metrics = None
+        metrics.finish()
+
+
+def init_app(app):
+    """Registers the request hooks and the /metrics endpoint on app."""
+    app.before_request(lambda: start_request_metrics(app))
+    app.after_request(lambda response: finish_request_metrics(app, response))
+    app.teardown_request(abandon_request_metrics)
+
+    @app.route("/metrics")
+    def metrics():
+        """Returns the aggregated request histograms and cache statistics
+        as JSON.
+        """
+        return jsonify(registry.snapshot(),
+                       caches={'contact_names': contact_name_cache.stats(),
+                               'timelines': timeline_cache.stats(),
+                               'pages': page_cache.stats()})
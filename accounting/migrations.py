@@ -0,0 +1,120 @@
+#!/user/bin/env python2.7
+
+from sqlalchemy.engine.reflection import Inspector
+
+from accounting import db
+from ledger import rebuild_entries
+from models import Invoice, LedgerEntry, Payment
+
+"""
+#######################################################
+Versioned schema migrations for an existing db.
+
+The applied version is kept in sqlite's user_version
+pragma. Every migration is safe to run against a db
+that already has its changes.
+#######################################################
+"""
+
+
+def create_ledger():
+    """Adds the ledger_entries table and fills it from the raw rows."""
+    LedgerEntry.__table__.create(bind=db.session.connection(), checkfirst=True)
+    create_missing_indexes(LedgerEntry.__table__)
+    rebuild_entries()
+
+
+def create_date_indexes():
+    """Adds the composite policy/date indexes on invoices and payments."""
+    create_missing_indexes(Invoice.__table__)
+    create_missing_indexes(Payment.__table__)
+
+
+def add_payment_idempotency_keys():
+    """Adds payments.idempotency_key and its unique index."""
+    connection = db.session.connection()
+    columns = [column['name'] for column in
+               Inspector.from_engine(connection).get_columns(Payment.__tablename__)]
+    if 'idempotency_key' not in columns:
+        connection.execute("ALTER TABLE payments ADD COLUMN idempotency_key VARCHAR(128)")
+    create_missing_indexes(Payment.__table__)
+
+
+def create_ledger_version_index():
+    """Adds the policy/id index the ledger version lookup reads."""
+    create_missing_indexes(LedgerEntry.__table__)
+
+
+def autoincrement_ledger_ids():
+    """Rebuilds ledger_entries with AUTOINCREMENT ids, keeping its rows and
+    their ids, so ids freed by a rebuild are never handed out again.
+    """
+    connection = db.session.connection()
+    table = LedgerEntry.__table__
+    sql = connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                             table.name).scalar()
+    if "AUTOINCREMENT" in sql.upper():
+        return
+
+    old_name = table.name + "_old"
+    connection.execute("ALTER TABLE %s RENAME TO %s" % (table.name, old_name))
+    # index names are global, the new table's indexes need them
+    for index in Inspector.from_engine(connection).get_indexes(old_name):
+        connection.execute("DROP INDEX %s" % index['name'])
+    table.create(bind=connection)
+    create_missing_indexes(table)
+    columns = ", ".join(column.name for column in table.columns)
+    connection.execute("INSERT INTO %s (%s) SELECT %s FROM %s ORDER BY id"
+                       % (table.name, columns, columns, old_name))
+    connection.execute("DROP TABLE %s" % old_name)
+
+
+# (version, description, migration) in the order they are applied
+MIGRATIONS = [
+    (1, "ledger_entries table", create_ledger),
+    (2, "policy/date indexes on invoices and payments", create_date_indexes),
+    (3, "idempotency keys on payments", add_payment_idempotency_keys),
+    (4, "policy/id index on ledger_entries", create_ledger_version_index),
+    (5, "AUTOINCREMENT ids on ledger_entries", autoincrement_ledger_ids),
+]
+
+
+def create_missing_indexes(table):
+    """Creates the model's indexes that are not in the db yet. Indexes on
+    columns a later migration adds are left for that migration.
+    """
+    connection = db.session.connection()
+    inspector = Inspector.from_engine(connection)
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+    columns = set(column['name'] for column in inspector.get_columns(table.name))
+    for index in table.indexes:
+        if index.name not in existing and \
+                all(column.name in columns for column in index.columns):
+            index.create(bind=connection)
+
+
+def current_version():
+    """Returns the schema version the db was last migrated to."""
+    return db.session.execute("PRAGMA user_version").scalar()
+
+
+def stamp_db(version=None):
+    """Marks the db as migrated, used after create_all builds it from scratch."""
+    if version is None:
+        version = MIGRATIONS[-1][0]
+    db.session.execute("PRAGMA user_version = %d" % version)
+    db.session.commit()
+
+
+def migrate_db():
+    """Applies every migration newer than the db, each in its own transaction."""
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version():
+            continue
+        migration()
+        db.session.execute("PRAGMA user_version = %d" % version)
+        db.session.commit()
+        applied.append(version)
+        print "Migrated to version %s: %s" % (version, description)
+    return applied
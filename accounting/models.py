@@ -74,9 +74,48 @@ class Payment(db.Model):
     contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
     amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
     transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+    # set by bulk imports so posting the same file twice is a no-op
+    idempotency_key = db.Column(u'idempotency_key', db.VARCHAR(length=128))
 
     def __init__(self, policy_id, contact_id, amount_paid, transaction_date):
         self.policy_id = policy_id
         self.contact_id = contact_id
         self.amount_paid = amount_paid
         self.transaction_date = transaction_date
+
+# composite indexes for the per-policy date filters in tools.py
+db.Index('ix_invoices_policy_id_bill_date', Invoice.policy_id, Invoice.bill_date)
+db.Index('ix_invoices_policy_id_due_date', Invoice.policy_id, Invoice.due_date)
+db.Index('ix_invoices_policy_id_cancel_date', Invoice.policy_id, Invoice.cancel_date)
+db.Index('ix_payments_policy_id_transaction_date', Payment.policy_id, Payment.transaction_date)
+db.Index('ux_payments_idempotency_key', Payment.idempotency_key, unique=True)
+
+
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+
+    # ids are never reused, so a policy's last id is its ledger version
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    entry_date = db.Column(u'entry_date', db.DATE(), nullable=False)
+    kind = db.Column(u'kind', db.Enum(u'Invoice', u'Payment', u'Reversal'), nullable=False)
+    amount = db.Column(u'amount', db.INTEGER(), nullable=False)
+    balance = db.Column(u'balance', db.INTEGER(), nullable=False)
+    invoice_id = db.Column(u'invoice_id', db.INTEGER())
+    payment_id = db.Column(u'payment_id', db.INTEGER())
+
+    def __init__(self, policy_id, entry_date, kind, amount, balance):
+        self.policy_id = policy_id
+        self.entry_date = entry_date
+        self.kind = kind
+        self.amount = amount
+        self.balance = balance
+
+# the balance lookup reads the latest entry on or before a date
+db.Index('ix_ledger_entries_policy_id_entry_date',
+         LedgerEntry.policy_id, LedgerEntry.entry_date, LedgerEntry.id)
+# and the page view checks the policy's last entry id
+db.Index('ix_ledger_entries_policy_id_id', LedgerEntry.policy_id, LedgerEntry.id)
@@ -0,0 +1,183 @@
+#!/user/bin/env python2.7
+
+import json
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import exists, select
+
+from accounting import db
+from models import Invoice, Policy
+from sweep import sweep_cancellations
+from tools import NEW_INVOICES_MESSAGE, logger, make_invoices_for_policies
+
+"""
+#######################################################
+Nightly billing and cancellation run.
+
+The policies table is split into ranges of ids that a
+process pool works through. Each worker bills the
+policies in its range that have no invoices yet (what
+constructing a PolicyAccounting would do) and then
+sweeps them for cancellation, all on its own sqlite
+connection. Finished ranges go to a JSON checkpoint
+so a crashed run picks up where it stopped.
+#######################################################
+"""
+
+policies_table = Policy.__table__
+invoices_table = Invoice.__table__
+
+# policies handed to a worker at a time
+RANGE_SIZE = 5000
+
+
+def id_ranges(range_size=RANGE_SIZE):
+    """Returns [min_id, max_id] pairs covering every policy, range_size
+    policies each.
+    """
+    policy_ids = [row[0] for row in db.session.execute(select([policies_table.c.id])
+                                                       .order_by(policies_table.c.id))]
+    return [[policy_ids[start], policy_ids[min(start + range_size, len(policy_ids)) - 1]]
+            for start in range(0, len(policy_ids), range_size)]
+
+
+def init_worker():
+    """Sets up a forked worker. Connections opened by the parent are dropped
+    so the worker gets its own, and the parent writes the policy logs since
+    only one process may write to the log store.
+    """
+    db.session.remove()
+    db.engine.dispose()
+    logger.active = False
+
+
+def run_range(id_range, date_cursor):
+    """Bills and sweeps the policies with ids in id_range, returns its stats.
+
+    id_range -- [min_id, max_id] inclusive
+    date_cursor -- Date object cancellations are evaluated for
+    """
+    started = time.time()
+    min_id, max_id = id_range
+    uninvoiced = select([policies_table.c.id])\
+                 .where(policies_table.c.id >= min_id)\
+                 .where(policies_table.c.id <= max_id)\
+                 .where(~exists([invoices_table.c.id])
+                          .where(invoices_table.c.policy_id == policies_table.c.id))
+    billed_ids = [row[0] for row in db.session.execute(uninvoiced)]
+
+    invoices = 0
+    if billed_ids:
+        invoices = make_invoices_for_policies(billed_ids)['invoices']
+    canceled = sweep_cancellations(date_cursor, min_id=min_id, max_id=max_id)
+    db.session.remove()
+
+    return {'range': id_range,
+            'worker': os.getpid(),
+            'billed_ids': billed_ids,
+            'invoices': invoices,
+            'canceled': len(canceled),
+            'seconds': time.time() - started}
+
+
+def _run_range(args):
+    return run_range(*args)
+
+
+def load_checkpoint(path, date_cursor, range_size):
+    """Returns the checkpoint at path if it is for the same run, else None."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint['date_cursor'] != date_cursor.isoformat() or \
+            checkpoint['range_size'] != range_size:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """Replaces the checkpoint at path in one rename."""
+    with open(path + ".tmp", 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(path + ".tmp", path)
+
+
+def merge_stats(results):
+    """Adds up the stats of finished ranges, overall and per worker."""
+    summary = {'ranges': len(results), 'billed': 0, 'invoices': 0, 'canceled': 0,
+               'workers': {}}
+    for result in results:
+        summary['billed'] += result['billed']
+        summary['invoices'] += result['invoices']
+        summary['canceled'] += result['canceled']
+        worker = summary['workers'].setdefault(str(result['worker']),
+                                               {'ranges': 0, 'seconds': 0.0})
+        worker['ranges'] += 1
+        worker['seconds'] += result['seconds']
+    return summary
+
+
+def run_nightly(date_cursor=None, workers=None, range_size=RANGE_SIZE, checkpoint_path=None):
+    """Bills and sweeps the whole book across a process pool and returns
+    the merged stats of every range, including ones finished by an earlier
+    run that was resumed from checkpoint_path.
+
+    date_cursor -- Date object (defaults to current date)
+    workers -- processes in the pool (defaults to one per cpu), 0 runs
+               every range in this process
+    range_size -- policies per range
+    checkpoint_path -- JSON file recording finished ranges (defaults to none)
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    started = time.time()
+    checkpoint = load_checkpoint(checkpoint_path, date_cursor, range_size)
+    if checkpoint is None:
+        checkpoint = {'date_cursor': date_cursor.isoformat(),
+                      'range_size': range_size,
+                      'ranges': id_ranges(range_size),
+                      'finished': []}
+    done = set(tuple(result['range']) for result in checkpoint['finished'])
+    todo = [(id_range, date_cursor) for id_range in checkpoint['ranges']
+            if tuple(id_range) not in done]
+    # sqlite connections must not cross a fork, the workers open their own
+    db.session.remove()
+    db.engine.dispose()
+
+    if workers:
+        pool = multiprocessing.Pool(workers, init_worker)
+        results = pool.imap_unordered(_run_range, todo)
+    else:
+        pool = None
+        results = (run_range(*args) for args in todo)
+
+    try:
+        for result in results:
+            billed_ids = result.pop('billed_ids')
+            if pool:
+                # workers leave the logging to this process
+                logger.log_many(NEW_INVOICES_MESSAGE, "Info", billed_ids)
+            result['billed'] = len(billed_ids)
+            checkpoint['finished'].append(result)
+            if checkpoint_path:
+                save_checkpoint(checkpoint_path, checkpoint)
+            print "Finished policies %s to %s" % tuple(result['range'])
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+
+    summary = merge_stats(checkpoint['finished'])
+    summary['resumed_ranges'] = len(done)
+    summary['seconds'] = time.time() - started
+    return summary
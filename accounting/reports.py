@@ -0,0 +1,131 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select
+from sqlalchemy.sql.expression import literal_column
+
+from accounting import db
+from models import Contact, Invoice, Payment, Policy
+
+"""
+#######################################################
+Receivables aging report.
+
+Payments are not tied to invoices, so each policy's
+payments are applied to its invoices oldest due date
+first. What is left on an invoice is bucketed by how
+many days it is past due as of the report date, then
+summed by agent and billing schedule, all in one
+grouped query. Python only sees one row per group.
+#######################################################
+"""
+
+invoices_table = Invoice.__table__
+payments_table = Payment.__table__
+policies_table = Policy.__table__
+contacts_table = Contact.__table__
+
+# (name, fewest days past due, most days past due) in report order
+AGING_BUCKETS = [('current', None, 0),
+                 ('1-30', 1, 30),
+                 ('31-60', 31, 60),
+                 ('61+', 61, None)]
+
+
+def aging_query(as_of):
+    """Returns the select of (agent_id, agent, billing_schedule, bucket,
+    outstanding) groups.
+
+    as_of -- Date object invoices and payments are counted up to
+    """
+    paid = select([payments_table.c.policy_id,
+                   func.sum(payments_table.c.amount_paid).label('paid')])\
+           .where(payments_table.c.transaction_date <= as_of)\
+           .group_by(payments_table.c.policy_id)\
+           .alias('paid')
+
+    # billed through each invoice, oldest due date first
+    billed = select([invoices_table.c.policy_id,
+                     invoices_table.c.due_date,
+                     invoices_table.c.amount_due,
+                     func.sum(invoices_table.c.amount_due)
+                         .over(partition_by=invoices_table.c.policy_id,
+                               order_by=[invoices_table.c.due_date, invoices_table.c.id])
+                         .label('billed_through')])\
+             .where(invoices_table.c.bill_date <= as_of)\
+             .alias('billed')
+
+    # payments cover billed_through - amount_due before reaching this invoice
+    unpaid = billed.c.billed_through - func.coalesce(paid.c.paid, 0)
+    outstanding = case([(unpaid <= 0, 0),
+                        (unpaid >= billed.c.amount_due, billed.c.amount_due)],
+                       else_=unpaid)
+
+    bucket_cases = []
+    for name, fewest_days, most_days in AGING_BUCKETS[:-1]:
+        bucket_cases.append((billed.c.due_date >= as_of - timedelta(days=most_days), name))
+    bucket = case(bucket_cases, else_=AGING_BUCKETS[-1][0])
+
+    invoice_rows = select([billed.c.policy_id,
+                           bucket.label('bucket'),
+                           outstanding.label('outstanding')])\
+                   .select_from(billed.outerjoin(paid, paid.c.policy_id == billed.c.policy_id))\
+                   .alias('invoice_rows')
+
+    agent = func.coalesce(contacts_table.c.name, literal_column("'No Agent'"))
+    return select([policies_table.c.agent.label('agent_id'),
+                   agent.label('agent'),
+                   policies_table.c.billing_schedule,
+                   invoice_rows.c.bucket,
+                   func.sum(invoice_rows.c.outstanding).label('outstanding')])\
+           .select_from(invoice_rows
+                        .join(policies_table, policies_table.c.id == invoice_rows.c.policy_id)
+                        .outerjoin(contacts_table, contacts_table.c.id == policies_table.c.agent))\
+           .where(invoice_rows.c.outstanding > 0)\
+           .group_by(policies_table.c.agent, agent, policies_table.c.billing_schedule,
+                     invoice_rows.c.bucket)
+
+
+def aging_report(as_of=None, session=None):
+    """Returns the aging report as a dict with one row per agent and
+    billing schedule holding the outstanding amount in each bucket, plus
+    the totals.
+
+    as_of -- Date object (defaults to current date)
+    session -- session to read with (defaults to db.read_session)
+    """
+    if not as_of:
+        as_of = datetime.now().date()
+    session = session or db.read_session
+
+    buckets = [name for name, fewest_days, most_days in AGING_BUCKETS]
+    rows = {}
+    totals = dict((name, 0) for name in buckets + ['total'])
+    for agent_id, agent, billing_schedule, bucket, outstanding in \
+            session.execute(aging_query(as_of)):
+        key = (agent, agent_id, billing_schedule)
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = dict((name, 0) for name in buckets)
+            row.update(agent_id=agent_id, agent=agent, billing_schedule=billing_schedule,
+                       total=0)
+        row[bucket] += outstanding
+        row['total'] += outstanding
+        totals[bucket] += outstanding
+        totals['total'] += outstanding
+
+    return {'as_of': as_of.isoformat(),
+            'buckets': buckets,
+            'rows': [rows[key] for key in sorted(rows)],
+            'totals': totals}
+
+
+def print_aging_report(report):
+    """Prints the report as a text table."""
+    columns = ['agent', 'billing_schedule'] + report['buckets'] + ['total']
+    widths = [24, 18] + [10] * (len(columns) - 2)
+    print "Aging as of %s" % report['as_of']
+    print "".join(column.ljust(width) for column, width in zip(columns, widths))
+    for row in report['rows'] + [dict(report['totals'], agent="Total", billing_schedule="")]:
+        print "".join(unicode(row[column]).ljust(width) for column, width in zip(columns, widths))
@@ -0,0 +1,83 @@
+#!/user/bin/env python2.7
+
+import os
+
+from accounting import db
+from contacts import contact_name_cache
+from timeline import invalidate_timelines
+
+"""
+#######################################################
+Snapshots of the whole db.
+
+snapshot_db writes a consistent copy of the db to a
+file with VACUUM INTO, and restore_db copies one back
+over the db's tables through an attached connection.
+Both work the same on the file and on SQLITE_MEMORY_DB,
+so a seeded template can be cloned into a fresh db in
+milliseconds. (The sqlite3 module of python 2.7 has no
+backup API to do this with.)
+#######################################################
+"""
+
+
+def snapshot_db(path):
+    """Writes a copy of the db to path, replacing what is there."""
+    db.session.commit()
+    if os.path.exists(path):
+        os.remove(path)
+    connection = db.engine.raw_connection()
+    try:
+        connection.cursor().execute("VACUUM INTO ?", (os.path.abspath(path),))
+    finally:
+        connection.close()
+
+
+def restore_db(path):
+    """Replaces every table in the db with the ones in the snapshot at path,
+    in one transaction. Open sessions are discarded.
+    """
+    if not os.path.exists(path):
+        raise IOError("No snapshot at %s" % path)
+    db.session.remove()
+    db.read_session.remove()
+
+    connection = db.engine.raw_connection()
+    # take over transaction handling from the sqlite3 module
+    dbapi_connection = connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    cursor = connection.cursor()
+    try:
+        cursor.execute("ATTACH DATABASE ? AS snapshot", (os.path.abspath(path),))
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            tables = cursor.execute("SELECT name FROM main.sqlite_master "
+                                    "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+            for (name,) in tables:
+                cursor.execute('DROP TABLE main."%s"' % name)
+
+            # tables before the indexes on them
+            schema = cursor.execute("SELECT type, name, sql FROM snapshot.sqlite_master "
+                                    "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                                    "ORDER BY type = 'index'").fetchall()
+            for object_type, name, sql in schema:
+                cursor.execute(sql)
+                if object_type == 'table':
+                    cursor.execute('INSERT INTO main."%s" SELECT * FROM snapshot."%s"'
+                                   % (name, name))
+            version = cursor.execute("PRAGMA snapshot.user_version").fetchone()[0]
+            cursor.execute("PRAGMA main.user_version = %d" % version)
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute("DETACH DATABASE snapshot")
+    finally:
+        cursor.close()
+        dbapi_connection.isolation_level = isolation_level
+        connection.close()
+
+    invalidate_timelines()
+    contact_name_cache.clear()
@@ -0,0 +1,50 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+
+from accounting import db
+from models import Policy
+from timeline import PolicyTimeline, chunked, iter_timelines
+
+"""
+#######################################################
+Read only balance and status summaries for many
+policies, answered with a few grouped queries per
+chunk of ids instead of one PolicyAccounting each.
+#######################################################
+"""
+
+
+def iter_policy_summaries(policy_ids, date_cursor=None):
+    """Yields a summary dict for each id, in the order given.
+
+    Each has the policy's balance, the status evaluate_cancel would give it
+    and whether it is in cancellation pending due to non-pay. Unknown ids
+    get an error instead.
+
+    policy_ids -- primary keys of policies table
+    date_cursor -- Date object (defaults to current date)
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    session = db.read_session
+    for id_group in chunked(policy_ids):
+        policies = dict(session.query(Policy.id, Policy.effective_date)
+                               .filter(Policy.id.in_(set(id_group))))
+        timelines = dict((timeline.policy_id, timeline) for timeline in
+                         iter_timelines(date_cursor, list(policies), session=session))
+
+        for policy_id in id_group:
+            if policy_id not in policies:
+                yield {'policy_id': policy_id,
+                       'error': "Unknown policy_id"}
+                continue
+
+            timeline = timelines.get(policy_id) or PolicyTimeline(policy_id)
+            cancel_date = timeline.cancel_date(date_cursor)
+            yield {'policy_id': policy_id,
+                   'balance': timeline.balance(date_cursor),
+                   'status': "Canceled" if cancel_date else "Active",
+                   'effective_date': (cancel_date or policies[policy_id]).isoformat(),
+                   'cancel_pending': timeline.cancel_pending(date_cursor)}
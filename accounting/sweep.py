@@ -0,0 +1,66 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+from accounting import db
+from models import Policy
+from timeline import chunked, iter_timelines, policy_filters
+
+"""
+#######################################################
+Book-wide cancellation sweep.
+
+Gives the same answer as PolicyAccounting.evaluate_cancel
+for every policy, but reads invoices and payments in two
+streaming queries and writes every change in bulk.
+#######################################################
+"""
+
+policies_table = Policy.__table__
+
+
+def sweep_cancellations(date_cursor=None, policy_ids=None, min_id=None, max_id=None):
+    """Evaluates cancellation for many policies at once and saves the results.
+
+    Returns a dict of policy_id -> cancel_date for the canceled policies,
+    every other policy swept is set back to Active like evaluate_cancel does.
+    Unlike PolicyAccounting, policies without invoices are not billed here.
+
+    date_cursor -- Date object (defaults to current date)
+    policy_ids -- only sweep these policies (defaults to the whole book)
+    min_id, max_id -- inclusive range of policy ids to sweep
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    canceled = {}
+    for timeline in iter_timelines(date_cursor, policy_ids, min_id, max_id):
+        cancel_date = timeline.cancel_date(date_cursor)
+        if cancel_date:
+            canceled[timeline.policy_id] = cancel_date
+
+    if policy_ids is None:
+        id_groups = [None]
+    else:
+        id_groups = chunked(policy_ids)
+
+    for id_group in id_groups:
+        reactivate = policies_table.update()\
+                                   .where(policies_table.c.status != u'Active')\
+                                   .values(status=u'Active')
+        for clause in policy_filters(policies_table.c.id, id_group, min_id, max_id):
+            reactivate = reactivate.where(clause)
+        db.session.execute(reactivate)
+
+    if canceled:
+        cancel = policies_table.update()\
+                               .where(policies_table.c.id == bindparam('policy_id'))\
+                               .values(status=u'Canceled',
+                                       effective_date=bindparam('cancel_date'))
+        db.session.execute(cancel, [{'policy_id': policy_id, 'cancel_date': cancel_date}
+                                    for policy_id, cancel_date in canceled.iteritems()])
+
+    db.session.commit()
+    return canceled
@@ -0,0 +1,318 @@
+#!/user/bin/env python2.7
+
+import weakref
+from bisect import bisect_right
+from itertools import groupby
+
+from sqlalchemy import event, or_, select
+from sqlalchemy.orm import Session
+
+from accounting import db, settings
+from cache import BoundedCache
+from models import Invoice, Payment
+
+"""
+#######################################################
+Policy timelines: every invoice and payment for a
+policy kept in date order with prefix sums, so account
+balances can be answered without going back to the db.
+
+Whole timelines are cached per policy. Flushes that
+touch a policy's invoices or payments drop its entry,
+and again when the transaction ends so nothing read
+mid transaction outlives it. Writes made by other
+processes show up once TIMELINE_CACHE_TTL passes.
+Rendered /view pages are kept alongside and dropped
+with their policy's timeline.
+#######################################################
+"""
+
+invoices_table = Invoice.__table__
+payments_table = Payment.__table__
+
+# sqlite refuses statements with too many bound parameters
+ID_CHUNK_SIZE = 500
+
+
+class PolicyTimeline(object):
+    """
+     Invoice and payment history for one policy.
+    """
+    def __init__(self, policy_id, invoices=(), payments=()):
+        """Builds the prefix sums used by every balance lookup.
+
+        policy_id -- Primary key of policies table
+        invoices -- (bill_date, due_date, cancel_date, amount_due, id) tuples
+                    ordered by bill_date
+        payments -- (transaction_date, amount_paid, id) tuples ordered by
+                    transaction_date
+        """
+        self.policy_id = policy_id
+        self.invoices = list(invoices)
+        self.bill_dates = []
+        self.billed = [0]
+        for invoice in sorted(self.invoices, key=lambda invoice: invoice[0]):
+            self.bill_dates.append(invoice[0])
+            self.billed.append(self.billed[-1] + invoice[3])
+
+        self.payments = list(payments)
+        self.payment_dates = []
+        self.paid = [0]
+        for payment in self.payments:
+            self.payment_dates.append(payment[0])
+            self.paid.append(self.paid[-1] + payment[1])
+
+    def balance(self, date_cursor):
+        """Invoices billed minus payments made on or before date_cursor."""
+        return self.billed[bisect_right(self.bill_dates, date_cursor)] \
+             - self.paid[bisect_right(self.payment_dates, date_cursor)]
+
+    def balances_at(self, dates):
+        """Returns the balance at each of the given dates, which must be
+        sorted, searching the events after the previous date's for each.
+        """
+        balances = []
+        billed_index = paid_index = 0
+        for date_cursor in dates:
+            billed_index = bisect_right(self.bill_dates, date_cursor, billed_index)
+            paid_index = bisect_right(self.payment_dates, date_cursor, paid_index)
+            balances.append(self.billed[billed_index] - self.paid[paid_index])
+        return balances
+
+    def cancel_pending(self, date_cursor):
+        """Same rule as evaluate_cancellation_pending_due_to_non_pay."""
+        due_dates = sorted(invoice[1] for invoice in self.invoices
+                           if invoice[1] <= date_cursor)
+        for balance in self.balances_at(due_dates):
+            if balance > 0:
+                return True
+        return False
+
+    def cancel_date(self, date_cursor):
+        """Same rule as evaluate_cancel, returns the cancel_date of the
+        first invoice (by bill_date) left unpaid or None.
+        """
+        candidates = [invoice[2] for invoice in self.invoices
+                      if invoice[2] <= date_cursor]
+        cancel_dates = sorted(set(candidates))
+        balances = dict(zip(cancel_dates, self.balances_at(cancel_dates)))
+        for cancel_date in candidates:
+            if balances[cancel_date]:
+                return cancel_date
+        return None
+
+    def totals(self):
+        """Returns the number and sum of the invoices and payments."""
+        return {'invoices': len(self.invoices), 'billed': self.billed[-1],
+                'payments': len(self.payments), 'paid': self.paid[-1]}
+
+    def next_change(self, date_cursor):
+        """Returns the first date after date_cursor on which any of the
+        lookups above can give a different answer, None if none can.
+        """
+        later = [event_date for invoice in self.invoices for event_date in invoice[1:3]
+                 if event_date > date_cursor]
+        for dates in (self.bill_dates, self.payment_dates):
+            index = bisect_right(dates, date_cursor)
+            if index < len(dates):
+                later.append(dates[index])
+        return min(later) if later else None
+
+    def last_change(self, date_cursor):
+        """Returns the last date on or before date_cursor on which any of the
+        lookups above started giving their current answer, None if none did.
+        """
+        earlier = [event_date for invoice in self.invoices for event_date in invoice[1:3]
+                   if event_date <= date_cursor]
+        for dates in (self.bill_dates, self.payment_dates):
+            index = bisect_right(dates, date_cursor)
+            if index:
+                earlier.append(dates[index - 1])
+        return max(earlier) if earlier else None
+
+
+def policy_filters(column, policy_ids=None, min_id=None, max_id=None):
+    """Returns where clauses restricting column to the requested policies."""
+    clauses = []
+    if policy_ids is not None:
+        clauses.append(column.in_(policy_ids))
+    if min_id is not None:
+        clauses.append(column >= min_id)
+    if max_id is not None:
+        clauses.append(column <= max_id)
+    return clauses
+
+
+def chunked(items, size=ID_CHUNK_SIZE):
+    """Splits items into lists of at most size items."""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def iter_timelines(date_cursor=None, policy_ids=None, min_id=None, max_id=None,
+                   session=None):
+    """Yields a PolicyTimeline for every policy with invoices or payments.
+
+    Invoices and payments are each read with one query ordered by policy
+    and merged as they stream in, so only one policy is held at a time.
+
+    date_cursor -- Date object, leaves out rows that cannot matter yet
+                   (defaults to no limit)
+    policy_ids -- only these policies (defaults to all)
+    min_id, max_id -- inclusive range of policy ids
+    session -- session to read with (defaults to db.session)
+    """
+    if policy_ids is not None and not policy_ids:
+        return
+    if policy_ids is not None and len(policy_ids) > ID_CHUNK_SIZE:
+        for chunk in chunked(sorted(set(policy_ids))):
+            for timeline in iter_timelines(date_cursor, chunk, min_id, max_id, session):
+                yield timeline
+        return
+
+    invoice_filters = policy_filters(invoices_table.c.policy_id,
+                                     policy_ids, min_id, max_id)
+    payment_filters = policy_filters(payments_table.c.policy_id,
+                                     policy_ids, min_id, max_id)
+    if date_cursor:
+        invoice_filters.append(or_(invoices_table.c.bill_date <= date_cursor,
+                                   invoices_table.c.due_date <= date_cursor,
+                                   invoices_table.c.cancel_date <= date_cursor))
+        payment_filters.append(payments_table.c.transaction_date <= date_cursor)
+
+    invoice_query = select([invoices_table.c.policy_id,
+                            invoices_table.c.bill_date,
+                            invoices_table.c.due_date,
+                            invoices_table.c.cancel_date,
+                            invoices_table.c.amount_due,
+                            invoices_table.c.id])\
+                    .order_by(invoices_table.c.policy_id,
+                              invoices_table.c.bill_date,
+                              invoices_table.c.id)
+    for clause in invoice_filters:
+        invoice_query = invoice_query.where(clause)
+
+    payment_query = select([payments_table.c.policy_id,
+                            payments_table.c.transaction_date,
+                            payments_table.c.amount_paid,
+                            payments_table.c.id])\
+                    .order_by(payments_table.c.policy_id,
+                              payments_table.c.transaction_date,
+                              payments_table.c.id)
+    for clause in payment_filters:
+        payment_query = payment_query.where(clause)
+
+    session = session or db.session
+    invoice_rows = session.execute(invoice_query)
+    payment_rows = session.execute(payment_query)
+
+    invoice_groups = groupby(invoice_rows, lambda row: row[0])
+    payment_groups = groupby(payment_rows, lambda row: row[0])
+    next_invoices = next(invoice_groups, None)
+    next_payments = next(payment_groups, None)
+
+    while next_invoices or next_payments:
+        if next_payments is None or \
+           (next_invoices and next_invoices[0] < next_payments[0]):
+            policy_id = next_invoices[0]
+        else:
+            policy_id = next_payments[0]
+
+        invoices = payments = ()
+        if next_invoices and next_invoices[0] == policy_id:
+            invoices = [tuple(row[1:]) for row in next_invoices[1]]
+            next_invoices = next(invoice_groups, None)
+        if next_payments and next_payments[0] == policy_id:
+            payments = [tuple(row[1:]) for row in next_payments[1]]
+            next_payments = next(payment_groups, None)
+
+        yield PolicyTimeline(policy_id, invoices, payments)
+
+
+################################
+# Timeline cache
+################################
+timeline_cache = BoundedCache(settings.get('TIMELINE_CACHE_SIZE', 10000),
+                              settings.get('TIMELINE_CACHE_TTL', 30))
+
+# rendered policy pages, dropped along with the policy's timeline
+page_cache = BoundedCache(settings.get('PAGE_CACHE_SIZE', 1000))
+
+# ledger version each cached timeline was last checked against, see fresh_timeline
+checked_versions = BoundedCache(settings.get('TIMELINE_CACHE_SIZE', 10000))
+
+# {session: policy ids flushed in its open transaction, None for all}
+_flushed_policy_ids = weakref.WeakKeyDictionary()
+
+
+def cached_timeline(policy_id, session=None):
+    """Returns the policy's PolicyTimeline covering every date, reading it
+    on a cache miss.
+
+    policy_id -- Primary key of policies table
+    session -- session to read with on a miss (defaults to db.session)
+    """
+    timeline = timeline_cache.get(policy_id)
+    if timeline is None:
+        version = timeline_cache.version
+        timeline = PolicyTimeline(policy_id)
+        for timeline in iter_timelines(policy_ids=[policy_id], session=session):
+            pass
+        timeline_cache.set(policy_id, timeline, version)
+    return timeline
+
+
+def fresh_timeline(policy_id, version, session=None):
+    """Returns the policy's cached timeline, reading it again when the
+    ledger has moved on since it was last checked, so writes from other
+    processes show up without waiting for TIMELINE_CACHE_TTL.
+
+    policy_id -- Primary key of policies table
+    version -- the policy's ledger_version now
+    session -- session to read with on a miss (defaults to db.session)
+    """
+    if checked_versions.get(policy_id) != version:
+        invalidate_timelines([policy_id])
+        checked_versions.set(policy_id, version)
+    return cached_timeline(policy_id, session)
+
+
+def invalidate_timelines(policy_ids=None):
+    """Drops cached timelines and the pages rendered from them.
+
+    policy_ids -- only these policies (defaults to all)
+    """
+    for cache in (timeline_cache, page_cache, checked_versions):
+        if policy_ids is None:
+            cache.clear()
+        else:
+            for policy_id in policy_ids:
+                cache.invalidate(policy_id)
+
+
+def _invalidate_flushed(session, flush_context):
+    policy_ids = _flushed_policy_ids.setdefault(session, set())
+    if policy_ids is None:
+        return
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, (Invoice, Payment)) and instance.policy_id is not None:
+            policy_ids.add(instance.policy_id)
+    invalidate_timelines(policy_ids)
+
+
+def _invalidate_bulk(session, query, query_context, result):
+    # Query.delete and Query.update do not say which policies they touched
+    _flushed_policy_ids[session] = None
+    invalidate_timelines()
+
+
+def _invalidate_transaction(session):
+    if session in _flushed_policy_ids:
+        invalidate_timelines(_flushed_policy_ids.pop(session))
+
+event.listen(Session, 'after_flush', _invalidate_flushed)
+event.listen(Session, 'after_bulk_delete', _invalidate_bulk)
+event.listen(Session, 'after_bulk_update', _invalidate_bulk)
+event.listen(Session, 'after_commit', _invalidate_transaction)
+event.listen(Session, 'after_rollback', _invalidate_transaction)
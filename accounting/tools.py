@@ -1,11 +1,22 @@
 #!/user/bin/env python2.7
 
+import os
+import time
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import bindparam, exists, select
 
-from accounting import db
+from accounting import db, settings
+from billing import billing_to_months, invoice_schedule, plan_rebilling
 from models import Contact, Invoice, Payment, Policy
+from ledger import ledger_balance, ledger_version, rebuild_entries, record_invoices, \
+                   record_payment, record_reversals
+from instrumentation import QueryRecorder
 from logger import Logger
+from migrations import stamp_db
+from snapshots import restore_db, snapshot_db
+from timeline import ID_CHUNK_SIZE, PolicyTimeline, cached_timeline, chunked, fresh_timeline, \
+                     iter_timelines
 
 """
 #######################################################
@@ -16,26 +27,60 @@ If you have any questions, please contact Amanda at:
 #######################################################
 """
 
-logger = Logger()
+logger = Logger(queued=settings.get('LOG_QUEUED', False),
+                log_dir=settings.get('LOG_DIR', "Logs"))
+
+NEW_INVOICES_MESSAGE = "New invoices are being made, invoices for this policy will be have a different invoice_id"
 
 class PolicyAccounting(object):
     """
      Each policy has its own instance of accounting.
     """
-    def __init__(self, policy_id):
+    # batch jobs hold many of these at once
+    __slots__ = ('policy', 'read_only', 'session')
+
+    def __init__(self, policy_id, read_only=False, policy=None, bill=True):
         """Constructs a object linking policies with invoices.
   
         policy_id -- Primary key of policies table
+        read_only -- never write or commit, so reads do not take the
+                     db write lock, and read through db.read_session
+                     (default False)
+        policy -- the Policy, if the caller already has it, saves the query
+        bill -- make the policy's invoices if it has none yet, see
+                ensure_invoices (default True)
         """
-        policy_query = Policy.query.filter_by(id=policy_id)
-        if policy_query.count() == 0:
+        self.read_only = read_only
+        self.session = db.read_session if read_only else db.session
+        if policy is None:
+            policy = self.session.query(Policy).filter_by(id=policy_id).first()
+        self.policy = policy
+        if self.policy is None:
             #create new policy
             print "Policy does not exist"
             logger.log_error(1, policy_id)  
-        else:
-            self.policy = policy_query.one() 
-            if not self.policy.invoices:
-                self.make_invoices()
+        elif bill:
+            self.ensure_invoices()
+
+    def ensure_invoices(self):
+        """Makes the policy's invoices if it has none yet. Returns True if it
+        did, read only instances never do.
+        """
+        if self.read_only:
+            return False
+        has_invoices = self.session.query(exists().where(Invoice.policy_id == self.policy.id))\
+                                   .scalar()
+        if has_invoices:
+            return False
+        self.make_invoices()
+        return True
+
+    def refuse_write(self):
+        """Logs and returns True if this instance may not write."""
+        if self.read_only:
+            logger.log_error(3, self.policy.id)
+            return True
+        return False
 
     def return_account_balance(self, date_cursor=None):
         """Return the current account balance based on invocies minus payments.
@@ -45,22 +90,19 @@ class PolicyAccounting(object):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.bill_date <= date_cursor)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
-        due_now = 0
-        for invoice in invoices:
-            due_now += invoice.amount_due
-
-        payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
-                                .all()
+        return self.return_timeline().balance(date_cursor)
 
-        for payment in payments:
-            due_now -= payment.amount_paid
-
-        return due_now
+    def return_timeline(self):
+        """Returns this policy's invoices and payments as a PolicyTimeline,
+        from the timeline cache when it is there. Read only instances may
+        see another process's writes up to TIMELINE_CACHE_TTL late, the
+        rest check the cached copy against the policy's ledger_version
+        since they act on what they read.
+        """
+        if self.read_only:
+            return cached_timeline(self.policy.id, self.session)
+        return fresh_timeline(self.policy.id, ledger_version(self.policy.id, self.session),
+                              self.session)
 
     def make_payment(self, contact_id=None, date_cursor=None, amount=0):
         """Inserts a payment into the database.
@@ -69,6 +111,9 @@ class PolicyAccounting(object):
         date_cursor -- Date object (defaults to current date) 
         amount -- decimal number (default 0)
         """
+        if self.refuse_write():
+            return False
+
         contact = Contact.query.filter_by(id=contact_id).one()
         if contact.role != "Agent" and self.evaluate_cancellation_pending_due_to_non_pay(date_cursor):
             logger.log_error(2, self.policy.id)
@@ -86,6 +131,8 @@ class PolicyAccounting(object):
                           amount,
                           date_cursor)
         db.session.add(payment)
+        db.session.flush()
+        record_payment(payment)
         db.session.commit()
 
         return payment
@@ -100,46 +147,44 @@ class PolicyAccounting(object):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.due_date <= date_cursor)\
-                                .order_by(Invoice.due_date)\
-                                .all()
+        # a single running balance pass over the invoice due dates
+        return self.return_timeline().cancel_pending(date_cursor)
 
-        for invoice in invoices:
-            if self.return_account_balance(invoice.due_date) > 0:
-                return True
-
-        return False
-
-    def evaluate_cancel(self, date_cursor=None):
-        """Returns true if a policy should be canceled.
+    def evaluate_status(self, date_cursor=None):
+        """Returns the (status, effective_date) evaluate_cancel would give
+        the policy, without changing it.
 
         date_cursor -- Date object (defaults to current date)
         """
-        self.policy.status = "Active"
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.cancel_date <= date_cursor)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
+        cancel_date = self.return_timeline().cancel_date(date_cursor)
+        if cancel_date:
+            return "Canceled", cancel_date
+        return "Active", self.policy.effective_date
 
-        for invoice in invoices:
-            if not self.return_account_balance(invoice.cancel_date):
-                continue
-            else:
-                self.policy.status = "Canceled"
-                self.policy.effective_date = invoice.cancel_date
-                db.session.commit()
-                return True
+    def evaluate_cancel(self, date_cursor=None):
+        """Returns true if a policy should be canceled, read only instances
+        leave the policy untouched.
 
+        date_cursor -- Date object (defaults to current date)
+        """
+        status, effective_date = self.evaluate_status(date_cursor)
+        if self.read_only:
+            return status == "Canceled"
+
+        self.policy.status = status
+        self.policy.effective_date = effective_date
         db.session.commit()
-        return False
+        return status == "Canceled"
 
 
     def make_invoices(self, end_date_cursor = None):
         """Produces next year's worth of invoices."""
+        if self.refuse_write():
+            return
+
         invoices = []
         if not end_date_cursor:
             if self.policy:
@@ -147,108 +192,332 @@ class PolicyAccounting(object):
             else:
                 end_date_cursor = datetime.now().date + relativedelta(days=365)
 
+        removed_invoices = []
         for invoice in self.policy.invoices:
             if not invoice.deleted:
                 db.session.delete(invoice)
+                removed_invoices.append(invoice)
             else:
                 invoices.append(invoice)
+        kept_invoices = len(invoices)
         
-        logger.log("New invoices are being made, invoices for this policy will be have a different invoice_id",
+        logger.log(NEW_INVOICES_MESSAGE,
                    "Info",
                    self.policy.id);
 
-        billing_schedules = {'Annual': None, 'Two-Pay': 2, 'Semi-Annual': 3, 'Quarterly': 4, 'Monthly': 12}
-        billing_to_months = {'Annual': 12, 'Two-Pay': 6, 'Quarterly': 3, 'Monthly': 1}
-
-        # create the first invoice
-        first_invoice = Invoice(self.policy.id,
-                                self.policy.effective_date, #bill_date
-                                self.policy.effective_date + relativedelta(months=1), #due
-                                self.policy.effective_date + relativedelta(months=1, days=14), #cancel
-                                self.policy.annual_premium)
-        invoices.append(first_invoice)
-
-        # find the months in the billing period
-        if billing_to_months.has_key(self.policy.billing_schedule):
-            months_in_billing_period = billing_to_months.get(self.policy.billing_schedule)
-        else:
+        if not billing_to_months.has_key(self.policy.billing_schedule):
             logger.log("Client tried using %s billing schedule" % (self.policy.billing_schedule), 
                        "Info",
                        self.policy.id)
             print "You have chosen a bad billing schedule."
 
-        del billing_schedules["Annual"] # leave out annual from here to simplify
-        if self.policy.billing_schedule in billing_schedules.keys(): 
-            # find amount of months between end_date_cursor and self.policy.effective_date
-            months_left = (end_date_cursor - self.policy.effective_date).days / 30
-
-            invoices_needed = int(months_left / billing_to_months.get(self.policy.billing_schedule))
-            first_invoice.amount_due = first_invoice.amount_due / invoices_needed
-            
-            # create the correct amount of invoices based on variables above
-            for i in range(1, invoices_needed):
-                months_after_eff_date = i * months_in_billing_period
-                bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-                invoice = Invoice(self.policy.id,
-                                  bill_date,
-                                  bill_date + relativedelta(months=1),
-                                  bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / invoices_needed)
-                invoices.append(invoice)
+        for bill_date, due_date, cancel_date, amount_due in \
+                invoice_schedule(self.policy.effective_date,
+                                 self.policy.billing_schedule,
+                                 self.policy.annual_premium,
+                                 end_date_cursor):
+            invoices.append(Invoice(self.policy.id, bill_date, due_date, cancel_date, amount_due))
 
         for invoice in invoices:
             db.session.add(invoice)
 
+        # keep the ledger in the same transaction as the invoices
+        record_reversals(removed_invoices)
+        db.session.flush()
+        record_invoices(invoices[kept_invoices:])
         db.session.commit()
         self.policy.invoices = invoices
 
-    def change_billing_schedule(self, new_billing_schedule, date_cursor=None):
-        """Changes the billing schedule of the current policy"""
-        billing_schedules = {'Annual': None, 'Two-Pay': 2, 'Semi-Annual': 3, 'Quarterly': 4, 'Monthly': 12}
-        if self.policy.billing_schedule not in billing_schedules.keys(): 
-            logger.log("Client tried using %s billing schedule" % (self.policy.billing_schedule), 
+    def change_billing_schedule(self, new_billing_schedule, date_cursor=None, dry_run=False):
+        """Changes the billing schedule of the current policy, see
+        rebill_policies. Returns the plan for the policy.
+
+        new_billing_schedule -- one of billing_to_months
+        date_cursor -- Date object the new schedule starts on (defaults to
+                       current date)
+        dry_run -- return the plan without writing anything (default False)
+        """
+        if not dry_run and self.refuse_write():
+            return
+
+        if new_billing_schedule not in billing_to_months:
+            logger.log("Client tried using %s billing schedule" % (new_billing_schedule),
                        "Info",
                        self.policy.id)
             print "You have chosen a bad billing schedule."
             return
-            
-        if not date_cursor:
-            date_cursor = datetime.now().date()
 
-        new_balance = self.return_account_balance(self.policy.effective_date + relativedelta(days=365))
+        # the rebilling reads the db, so it has to see changes made through the session
+        self.session.flush()
+        stats = rebill_policies([self.policy.id], new_billing_schedule, date_cursor,
+                                dry_run, self.session)
+        return stats['plans'][self.policy.id]
 
-        # delete all old invoices
-        for each_invoice in self.policy.invoices: 
-            if self.return_account_balance(each_invoice.due_date) == 0:
-                each_invoice.deleted = True
-            else:
-                db.session.delete(each_invoice)
+      
 
-        # change billing schedule and effective date of policy
-        self.policy.billing_schedule = new_billing_schedule
-        old_effective_date = self.policy.effective_date
-        self.policy.effective_date = date_cursor
-        self.policy.annual_premium = new_balance
-        
-        # call make_invoices to create new invoices
-        self.make_invoices(self.policy.effective_date + relativedelta(days=365))
+def accounting_for_policies(policy_ids, read_only=False):
+    """Returns {policy_id: PolicyAccounting} for the ids that exist, reading
+    the policies with one query per chunk of ids. Nothing is billed, call
+    ensure_invoices or make_invoices_for_policies for that.
 
-        db.session.commit()
+    policy_ids -- primary keys of policies table
+    read_only -- passed on to every PolicyAccounting (default False)
+    """
+    session = db.read_session if read_only else db.session
+    accountings = {}
+    for id_group in chunked(set(policy_ids)):
+        for policy in session.query(Policy).filter(Policy.id.in_(id_group)):
+            accountings[policy.id] = PolicyAccounting(policy.id, read_only, policy, bill=False)
+    return accountings
+
+
+def rebill_policies(policy_ids, new_billing_schedule, date_cursor=None, dry_run=False,
+                    session=None, chunk_size=ID_CHUNK_SIZE):
+    """Moves many policies onto a new billing schedule the way
+    change_billing_schedule does. Old invoices are classified with one
+    running balance pass per policy (see billing.plan_rebilling), and each
+    chunk of policies is rewritten with bulk statements in one transaction.
+    Returns the counts and, for a dry run or a single policy, the plan
+    for each policy.
+
+    policy_ids -- policies to rebill
+    new_billing_schedule -- one of billing_to_months
+    date_cursor -- Date object the new schedule starts on (defaults to
+                   current date)
+    dry_run -- plan without writing anything (default False)
+    session -- session to read and write with (defaults to db.session)
+    chunk_size -- policies written per transaction
+    """
+    if new_billing_schedule not in billing_to_months:
+        raise ValueError("Unknown billing schedule: %s" % new_billing_schedule)
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    session = session or db.session
+    policy_ids = list(policy_ids)
+
+    started = time.time()
+    policies_table = Policy.__table__
+    invoices_table = Invoice.__table__
+    stats = {'policies': 0, 'soft_deleted': 0, 'hard_deleted': 0, 'invoices': 0}
+    plans = {}
+    for id_group in chunked(policy_ids, chunk_size):
+        effective_dates = dict(session.execute(select([policies_table.c.id,
+                                                       policies_table.c.effective_date])
+                                               .where(policies_table.c.id.in_(id_group)))
+                               .fetchall())
+        timelines = dict((timeline.policy_id, timeline) for timeline in
+                         iter_timelines(policy_ids=list(effective_dates), session=session))
+        group_plans = [plan_rebilling(timelines.get(policy_id) or PolicyTimeline(policy_id),
+                                      effective_date, new_billing_schedule, date_cursor)
+                       for policy_id, effective_date in sorted(effective_dates.items())]
+
+        for plan in group_plans:
+            stats['policies'] += 1
+            stats['soft_deleted'] += len(plan['soft_deleted'])
+            stats['hard_deleted'] += len(plan['hard_deleted'])
+            stats['invoices'] += len(plan['invoices'])
+        if dry_run or len(policy_ids) == 1:
+            plans.update((plan['policy_id'], plan) for plan in group_plans)
+        if dry_run or not group_plans:
+            continue
+
+        soft_deleted = [invoice_id for plan in group_plans for invoice_id in plan['soft_deleted']]
+        hard_deleted = [invoice_id for plan in group_plans for invoice_id in plan['hard_deleted']]
+        for invoice_ids in chunked(soft_deleted):
+            session.execute(invoices_table.update()
+                            .where(invoices_table.c.id.in_(invoice_ids))
+                            .values(deleted=True))
+        for invoice_ids in chunked(hard_deleted):
+            session.execute(invoices_table.delete().where(invoices_table.c.id.in_(invoice_ids)))
+
+        session.execute(policies_table.update()
+                        .where(policies_table.c.id == bindparam('policy_id'))
+                        .values(billing_schedule=bindparam('new_billing_schedule'),
+                                effective_date=bindparam('new_effective_date'),
+                                annual_premium=bindparam('new_annual_premium')),
+                        [{'policy_id': plan['policy_id'],
+                          'new_billing_schedule': plan['billing_schedule'],
+                          'new_effective_date': plan['effective_date'],
+                          'new_annual_premium': plan['annual_premium']}
+                         for plan in group_plans])
+        rows = [{'policy_id': plan['policy_id'],
+                 'bill_date': bill_date,
+                 'due_date': due_date,
+                 'cancel_date': cancel_date,
+                 'amount_due': amount_due,
+                 'deleted': False}
+                for plan in group_plans
+                for bill_date, due_date, cancel_date, amount_due in plan['invoices']]
+        if rows:
+            session.execute(invoices_table.insert(), rows)
+
+        logger.log_many(NEW_INVOICES_MESSAGE,
+                        "Info",
+                        [plan['policy_id'] for plan in group_plans])
+        # replaying the ledger commits the chunk
+        rebuild_entries([plan['policy_id'] for plan in group_plans], session)
+
+    stats['seconds'] = time.time() - started
+    stats['plans'] = plans
+    return stats
+
+
+def make_invoices_for_policies(policy_ids=None, chunk_size=ID_CHUNK_SIZE):
+    """Regenerates invoices for many policies the way make_invoices does,
+    with bulk statements and one transaction per chunk of policies.
+    Returns the counts and throughput.
+
+    policy_ids -- policies to bill (defaults to the whole book)
+    chunk_size -- policies written per transaction
+    """
+    started = time.time()
+    if policy_ids is None:
+        policy_ids = [policy_id for (policy_id,) in
+                      db.session.query(Policy.id).order_by(Policy.id)]
+
+    policies_table = Policy.__table__
+    invoices_table = Invoice.__table__
+    billed_policies = billed_invoices = 0
+    for id_group in chunked(policy_ids, chunk_size):
+        rows = []
+        billed_ids = []
+        for policy_id, effective_date, billing_schedule, annual_premium in \
+                db.session.execute(select([policies_table.c.id,
+                                           policies_table.c.effective_date,
+                                           policies_table.c.billing_schedule,
+                                           policies_table.c.annual_premium])
+                                   .where(policies_table.c.id.in_(id_group))):
+            if not billing_to_months.has_key(billing_schedule):
+                logger.log("Client tried using %s billing schedule" % (billing_schedule),
+                           "Info",
+                           policy_id)
+            billed_ids.append(policy_id)
+            for bill_date, due_date, cancel_date, amount_due in \
+                    invoice_schedule(effective_date, billing_schedule, annual_premium):
+                rows.append({'policy_id': policy_id,
+                             'bill_date': bill_date,
+                             'due_date': due_date,
+                             'cancel_date': cancel_date,
+                             'amount_due': amount_due,
+                             'deleted': False})
+
+        db.session.execute(invoices_table.delete()
+                           .where(invoices_table.c.policy_id.in_(billed_ids))
+                           .where(invoices_table.c.deleted == False))
+        if rows:
+            db.session.execute(invoices_table.insert(), rows)
+
+        logger.log_many(NEW_INVOICES_MESSAGE,
+                        "Info",
+                        billed_ids)
+        # replaying the ledger commits the chunk
+        rebuild_entries(billed_ids)
+        billed_policies += len(billed_ids)
+        billed_invoices += len(rows)
+
+    seconds = time.time() - started
+    stats = {'policies': billed_policies,
+             'invoices': billed_invoices,
+             'seconds': seconds,
+             'invoices_per_second': billed_invoices / seconds if seconds else 0}
+    print "Billed %(policies)s policies, %(invoices)s invoices in %(seconds).2fs " \
+          "(%(invoices_per_second)d invoices/s)" % stats
+    return stats
 
-      
 
 ################################
 # The functions below are for the db and 
 # shouldn't need to be edited.
 ################################
-def build_or_refresh_db():
+def build_or_refresh_db(template=None):
+    """Rebuilds the db with the initial data.
+
+    template -- snapshot file to restore the seeded db from, written on the
+                first build when it does not exist yet (defaults to none)
+    """
+    if template and os.path.exists(template):
+        restore_db(template)
+        print "DB Ready!"
+        return
+
     logger.off()
     db.drop_all()
     db.create_all()
+    stamp_db()
     insert_data()
     logger.on()
+    if template:
+        snapshot_db(template)
     print "DB Ready!"
 
+def explain_hot_queries(policy_id=None, date_cursor=None):
+    """Prints sqlite's EXPLAIN QUERY PLAN for the queries run by balance,
+    cancellation, ledger and sweep lookups. Returns the plans by name.
+
+    policy_id -- policy to run the lookups for (defaults to one with invoices)
+    date_cursor -- Date object (defaults to current date)
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if policy_id is None:
+        policy_id = db.session.query(Invoice.policy_id).first()[0]
+
+    pa = PolicyAccounting(policy_id)
+    hot_calls = [
+        ('return_account_balance',
+         lambda: pa.return_account_balance(date_cursor)),
+        ('evaluate_cancellation_pending_due_to_non_pay',
+         lambda: pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor)),
+        ('ledger_balance',
+         lambda: ledger_balance(policy_id, date_cursor)),
+        ('sweep_cancellations',
+         lambda: list(iter_timelines(date_cursor, min_id=policy_id, max_id=policy_id))),
+    ]
+
+    plans = {}
+    # raw dbapi cursor, the statements are already compiled for sqlite
+    cursor = db.session.connection().connection.cursor()
+    for name, call in hot_calls:
+        with QueryRecorder() as recorder:
+            call()
+        print name
+        plans[name] = []
+        for statement, parameters in recorder.selects():
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            plans[name].append(plan)
+            print "  " + " ".join(statement.split())
+            for detail in plan:
+                print "    " + detail
+    return plans
+
+def rebuild_ledger(policy_ids=None):
+    """Regenerates the ledger from the invoices and payments tables and
+    checks every entry date against return_account_balance.
+
+    policy_ids -- only rebuild these policies (defaults to the whole book)
+    """
+    rebuilt = rebuild_entries(policy_ids)
+    mismatches = []
+    for timeline in iter_timelines(policy_ids=policy_ids):
+        if timeline.invoices:
+            expected_balance = PolicyAccounting(timeline.policy_id).return_account_balance
+        else:
+            # PolicyAccounting would bill a policy without invoices
+            expected_balance = timeline.balance
+
+        for date_cursor in sorted(set(timeline.bill_dates + timeline.payment_dates)):
+            balance = ledger_balance(timeline.policy_id, date_cursor)
+            expected = expected_balance(date_cursor)
+            if balance != expected:
+                mismatches.append((timeline.policy_id, date_cursor, balance, expected))
+
+    if mismatches:
+        print "Ledger has %s mismatched balances!" % len(mismatches)
+    else:
+        print "Ledger Ready! %s policies rebuilt." % rebuilt
+    return mismatches
+
 def insert_data():
     #Contacts
     contacts = []
@@ -302,5 +571,7 @@ def insert_data():
 
     payment_for_p2 = Payment(p2.id, anna_white.id, 400, date(2015, 2, 1))
     db.session.add(payment_for_p2)
+    db.session.flush()
+    record_payment(payment_for_p2)
     db.session.commit()
 
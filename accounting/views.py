@@ -1,22 +1,82 @@
 # You will probably need more methods from flask but this one is a good start.
 from flask import *
 
-# Import things from Flask that we need.
-from accounting import app, db
+from accounting import db
 
 # Import our models
 from models import Contact, Invoice, Policy, Payment
 
+from contacts import contact_names
+from export import EXPORT_FORMATS, iter_export
+from history import HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE, decode_cursor, history_totals, \
+                    invoice_page, payment_page
+from ledger import ledger_version
+from reports import aging_report
+from summaries import iter_policy_summaries
+from timeline import fresh_timeline, page_cache
 from tools import *
 
 from datetime import date, datetime
+import hashlib
 import os
 
-# Routing for the server.
-@app.route("/view/")
-@app.route("/view/<policy_id>")
-@app.route("/view/<policy_id>/")
-@app.route("/view/<policy_id>/<year>/<month>/<day>")
+def policy_etag(policy, version, timeline, date_cursor, url):
+    """Returns the ETag of a policy page, which holds until the policy row
+    or its ledger changes or the date reaches the timeline's next change.
+
+    url -- path and query string the page was asked for, its links are
+           built from them
+    """
+    return hashlib.sha1(repr((policy.id, policy.policy_number, policy.effective_date,
+                              policy.status, policy.billing_schedule, policy.annual_premium,
+                              policy.named_insured, policy.agent, version,
+                              timeline.next_change(date_cursor), url)))\
+                  .hexdigest()
+
+
+def policy_last_modified(policy, timeline, date_cursor):
+    """Returns midnight of the last date on or before date_cursor that the
+    policy's page changed on, None if it has not yet.
+    """
+    changes = [change for change in (timeline.last_change(date_cursor), policy.effective_date)
+               if change and change <= date_cursor]
+    if not changes:
+        return None
+    return datetime.combine(max(changes), datetime.min.time())
+
+
+def page_url(**cursors):
+    """Returns the url of this policy page with the history cursors changed."""
+    args = dict(request.view_args, **request.args.to_dict())
+    args.update(cursors)
+    return url_for('index', **args)
+
+
+def render_policy(pa, date_cursor, invoices_after=None, payments_after=None):
+    status, effective_date = pa.evaluate_status(date_cursor)
+
+    # one page of each history, payments with their contact names
+    invoices, next_invoices = invoice_page(pa.policy.id, invoices_after, session=pa.session)
+    payments, next_payments = payment_page(pa.policy.id, payments_after, session=pa.session)
+
+    names = contact_names([pa.policy.agent, pa.policy.named_insured], pa.session)
+
+    pa.policy.amount_due = pa.return_account_balance(date_cursor) 
+    
+    return render_template('view.html', policy=pa.policy,
+                           status=status,
+                           effective_date=effective_date,
+                           agent=names.get(pa.policy.agent),
+                           named_insured=names.get(pa.policy.named_insured),
+                           totals=pa.return_timeline().totals(),
+                           invoices=invoices,
+                           payments=payments,
+                           first_invoices=invoices_after and page_url(invoices_after=None),
+                           next_invoices=next_invoices and page_url(invoices_after=next_invoices),
+                           first_payments=payments_after and page_url(payments_after=None),
+                           next_payments=next_payments and page_url(payments_after=next_payments))
+
+
 def index(policy_id=None, year=None, month=None, day=None):
     url_for('static', filename='style.css')
     if policy_id == None:
@@ -27,19 +87,167 @@ def index(policy_id=None, year=None, month=None, day=None):
     else:
         date_cursor = date(int(year), int(month), int(day))
 
-    pa = PolicyAccounting(policy_id)
-    pa.evaluate_cancel(date_cursor)
+    invoices_after = request.args.get('invoices_after')
+    payments_after = request.args.get('payments_after')
+    try:
+        for cursor in (invoices_after, payments_after):
+            if cursor:
+                decode_cursor(cursor)
+    except ValueError:
+        abort(400)
 
-    if pa.policy.agent:
-        pa.policy.agent = Contact.query.filter_by(id=pa.policy.agent).one().name
+    # the view never writes, so page loads do not queue on the write lock
+    pa = PolicyAccounting(policy_id, read_only=True)
 
-    if pa.policy.named_insured:
-        pa.policy.named_insured = Contact.query.filter_by(id=pa.policy.named_insured).one().name
+    version = ledger_version(pa.policy.id, pa.session)
+    timeline = fresh_timeline(pa.policy.id, version, pa.session)
+    etag = policy_etag(pa.policy, version, timeline, date_cursor,
+                       "%s?%s" % (request.path, request.query_string))
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        # (etag, body) of the last first page rendered, the ETag covers the
+        # url so a page is only served again for the url it was rendered for
+        page = page_cache.get(pa.policy.id)
+        if page is None or page[0] != etag:
+            page = (etag, render_policy(pa, date_cursor, invoices_after, payments_after))
+            # only first pages are kept, later ones are rarely asked for twice
+            if not (invoices_after or payments_after):
+                page_cache.set(pa.policy.id, page)
+        response = make_response(page[1])
+    # only the ETag answers conditional requests: a backdated write can
+    # change the page without moving Last-Modified
+    response.last_modified = policy_last_modified(pa.policy, timeline, date_cursor)
+    response.set_etag(etag)
+    return response
 
-    pa.policy.payments = Payment.query.filter_by(policy_id=pa.policy.id).all()
-    for payment in pa.policy.payments:
-        payment.contact = Contact.query.filter_by(id=payment.contact_id).one().name
-    
-    pa.policy.amount_due = pa.return_account_balance(date_cursor) 
-    
-    return render_template('view.html', policy=pa.policy)
+
+def history(policy_id, kind):
+    """Returns a page of a policy's invoices or payments as JSON, with the
+    cursor of the next page and the count and sum of all of them.
+
+    ?after=<cursor> (defaults to the first page) and ?limit=N (defaults to
+    HISTORY_PAGE_SIZE, at most MAX_HISTORY_PAGE_SIZE).
+    """
+    try:
+        limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+        if not 0 < limit <= MAX_HISTORY_PAGE_SIZE:
+            raise ValueError(limit)
+        after = request.args.get('after')
+        if after:
+            decode_cursor(after)
+    except ValueError:
+        response = jsonify(error="limit must be 1 to %d and after a cursor from an earlier page"
+                                 % MAX_HISTORY_PAGE_SIZE)
+        response.status_code = 400
+        return response
+
+    session = db.read_session
+    if not session.query(Policy.id).filter(Policy.id == policy_id).first():
+        response = jsonify(error="Unknown policy_id")
+        response.status_code = 404
+        return response
+
+    page = invoice_page if kind == 'invoices' else payment_page
+    rows, next_after = page(policy_id, after, limit, session)
+    count, total = history_totals(policy_id, kind, session)
+    return jsonify({'policy_id': policy_id,
+                    kind: [dict((key, value.isoformat() if hasattr(value, 'isoformat') else value)
+                                for key, value in row.items()) for row in rows],
+                    'next_after': next_after,
+                    'count': count,
+                    'total': total})
+
+
+def balances():
+    """Streams a JSON list of balance/status summaries for many policies.
+
+    Ids come from a POSTed JSON body {"policy_ids": [...], "date": "YYYY-MM-DD"}
+    or the query string ?ids=1,2,3&date=YYYY-MM-DD.
+    """
+    params = request.json if request.method == 'POST' and request.json else {}
+    try:
+        if 'policy_ids' in params:
+            policy_ids = [int(policy_id) for policy_id in params['policy_ids']]
+        else:
+            policy_ids = [int(policy_id) for policy_id in
+                          request.args.get('ids', '').split(',') if policy_id]
+        date_param = params.get('date') or request.args.get('date')
+        if date_param:
+            date_cursor = datetime.strptime(date_param, "%Y-%m-%d").date()
+        else:
+            date_cursor = datetime.now().date()
+    except (TypeError, ValueError):
+        response = jsonify(error="policy_ids must be integers and date YYYY-MM-DD")
+        response.status_code = 400
+        return response
+
+    def generate():
+        yield '['
+        for i, summary in enumerate(iter_policy_summaries(policy_ids, date_cursor)):
+            yield (',\n' if i else '\n') + json.dumps(summary)
+        yield '\n]\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def export():
+    """Streams every invoice and payment in the book with running balances.
+
+    ?format=csv|ndjson (default csv), ?gzip=1 to compress and
+    ?as_of=YYYY-MM-DD to leave out later rows.
+    """
+    file_format = request.args.get('format', 'csv')
+    compress = request.args.get('gzip') in ('1', 'true')
+    try:
+        as_of = request.args.get('as_of')
+        if as_of:
+            as_of = datetime.strptime(as_of, "%Y-%m-%d").date()
+        if file_format not in EXPORT_FORMATS:
+            raise ValueError(file_format)
+    except ValueError:
+        response = jsonify(error="format must be csv or ndjson and as_of YYYY-MM-DD")
+        response.status_code = 400
+        return response
+
+    filename = "book-%s.%s" % ((as_of or datetime.now().date()).isoformat(), file_format)
+    if compress:
+        filename += ".gz"
+    response = Response(stream_with_context(iter_export(file_format, compress, as_of)),
+                        mimetype="application/gzip" if compress
+                                 else EXPORT_FORMATS[file_format])
+    response.headers['Content-Disposition'] = "attachment; filename=%s" % filename
+    return response
+
+
+def aging():
+    """Outstanding amounts by agent, billing schedule and days past due.
+
+    ?as_of=YYYY-MM-DD (defaults to today), ?format=json for JSON instead
+    of a page.
+    """
+    try:
+        as_of = request.args.get('as_of')
+        if as_of:
+            as_of = datetime.strptime(as_of, "%Y-%m-%d").date()
+    except ValueError:
+        response = jsonify(error="as_of must be YYYY-MM-DD")
+        response.status_code = 400
+        return response
+
+    report = aging_report(as_of)
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template('aging.html', report=report)
+
+
+def init_app(app):
+    """Registers the routes on app."""
+    for rule in ("/view/", "/view/<policy_id>", "/view/<policy_id>/",
+                 "/view/<policy_id>/<year>/<month>/<day>"):
+        app.add_url_rule(rule, view_func=index)
+    app.add_url_rule("/api/balances", view_func=balances, methods=['GET', 'POST'])
+    app.add_url_rule("/api/export", view_func=export)
+    app.add_url_rule("/api/policies/<int:policy_id>/<any(invoices, payments):kind>",
+                     view_func=history)
+    app.add_url_rule("/reports/aging", view_func=aging)
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+import argparse
+import json
+from datetime import datetime
+
+from accounting.reports import aging_report, print_aging_report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print outstanding amounts by agent, "
+                                                 "billing schedule and days past due.")
+    parser.add_argument('--as-of', help="YYYY-MM-DD (defaults to today)")
+    parser.add_argument('--json', action='store_true', help="print JSON instead of a table")
+    args = parser.parse_args()
+
+    as_of = datetime.strptime(args.as_of, "%Y-%m-%d").date() if args.as_of else None
+    report = aging_report(as_of)
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print_aging_report(report)
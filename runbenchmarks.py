@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import argparse
+from datetime import datetime
+
+from accounting import db, settings
+from accounting.benchmark import BENCHMARKS, compare_results, generate_book, \
+                                 load_results, print_import_results, print_results, \
+                                 run_benchmarks, run_concurrency_benchmark, save_results, \
+                                 time_imports
+from accounting.migrations import migrate_db
+from accounting.snapshots import restore_db, snapshot_db
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build synthetic books and time PolicyAccounting. "
+                                                 "The db is accounting.sqlite in the current directory.")
+    commands = parser.add_subparsers(dest='command')
+
+    generate = commands.add_parser('generate', help="add a synthetic book to the db")
+    generate.add_argument('policies', type=int)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.add_argument('--snapshot', help="also write the db to this file for run --restore")
+
+    run = commands.add_parser('run', help="time the benchmarks against the db")
+    run.add_argument('--sample', type=int, default=100, help="policies per benchmark")
+    run.add_argument('--date', help="YYYY-MM-DD the calls are made for (defaults to today)")
+    run.add_argument('--only', action='append', choices=[name for name, prepare in BENCHMARKS])
+    run.add_argument('--save', help="write the results to this JSON file")
+    run.add_argument('--compare', help="JSON file from an earlier run to check for regressions")
+    run.add_argument('--tolerance', type=float, default=0.10)
+    run.add_argument('--restore', help="load this snapshot into the db before timing")
+
+    concurrency = commands.add_parser('concurrency',
+                                      help="mix reader threads with make_payment writers")
+    concurrency.add_argument('--readers', type=int, default=4)
+    concurrency.add_argument('--writers', type=int, default=1)
+    concurrency.add_argument('--seconds', type=float, default=5.0)
+    concurrency.add_argument('--date', help="YYYY-MM-DD the calls are made for (defaults to today)")
+    concurrency.add_argument('--untuned', action='store_true',
+                             help="use sqlite's default pragmas and no connection pool")
+    concurrency.add_argument('--read-connections', action='store_true',
+                             help="send the readers to the query_only connections")
+
+    imports = commands.add_parser('imports',
+                                  help="time importing the headless code against the web app")
+    imports.add_argument('--runs', type=int, default=5, help="fresh interpreters per target")
+
+    args = parser.parse_args()
+    if args.command == 'imports':
+        print_import_results(time_imports(args.runs))
+    elif args.command == 'concurrency':
+        # the engine reads these when it is first used
+        if args.untuned:
+            settings.update(SQLITE_JOURNAL_MODE='DELETE', SQLITE_SYNCHRONOUS='FULL',
+                            SQLITE_BUSY_TIMEOUT=None, SQLITE_CACHE_SIZE=None,
+                            SQLITE_POOL_SIZE=None)
+        settings['SQLITE_READ_CONNECTIONS'] = args.read_connections
+        date_cursor = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else None
+        results = run_concurrency_benchmark(args.readers, args.writers, args.seconds, date_cursor)
+        print results['meta']
+        for kind in ('readers', 'writers'):
+            print kind, results[kind]
+    elif args.command == 'generate':
+        db.create_all()
+        migrate_db()
+        print generate_book(args.policies, seed=args.seed)
+        if args.snapshot:
+            snapshot_db(args.snapshot)
+    else:
+        if args.restore:
+            restore_db(args.restore)
+        date_cursor = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else None
+        results = run_benchmarks(args.sample, date_cursor, names=args.only)
+        print_results(results)
+        if args.save:
+            save_results(results, args.save)
+        if args.compare:
+            regressions = compare_results(load_results(args.compare), results, args.tolerance)
+            for name, metric, old, new in regressions:
+                print "REGRESSION %s %s: %s -> %s" % (name, metric, old, new)
+            if regressions:
+                raise SystemExit(1)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+import argparse
+import sys
+from datetime import datetime
+
+from accounting.export import EXPORT_FORMATS, export_book
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write every invoice and payment in the "
+                                                 "book with running balances.")
+    parser.add_argument('export_file', nargs='?', default='-',
+                        help="file to write (defaults to stdout)")
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS),
+                        help="defaults to guessing from the file name, else csv")
+    parser.add_argument('--gzip', action='store_true',
+                        help="compress the output (default when the file name ends in .gz)")
+    parser.add_argument('--as-of', help="YYYY-MM-DD, leaves out later rows")
+    args = parser.parse_args()
+
+    name = args.export_file
+    compress = args.gzip or name.endswith(".gz")
+    file_format = args.format
+    if file_format is None:
+        file_format = "ndjson" if name.replace(".gz", "").endswith((".ndjson", ".jsonl")) \
+                      else "csv"
+    as_of = datetime.strptime(args.as_of, "%Y-%m-%d").date() if args.as_of else None
+
+    if name == '-':
+        export_book(sys.stdout, file_format, compress, as_of)
+    else:
+        with open(name, 'wb') as export_file:
+            written = export_book(export_file, file_format, compress, as_of)
+        print >> sys.stderr, "Wrote %s bytes to %s" % (written, name)
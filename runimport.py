@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+import argparse
+import json
+
+from accounting.importer import IMPORT_CHUNK_SIZE, import_payments
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post a lockbox or ACH payment file. "
+                                                 "Posting the same file again is a no-op.")
+    parser.add_argument('payment_file', type=argparse.FileType('rb'))
+    parser.add_argument('--format', choices=['csv', 'ndjson'],
+                        help="defaults to guessing from the file name")
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE,
+                        help="payments posted per transaction")
+    parser.add_argument('--source',
+                        help="names the file in the keys of rows without an idempotency_key, "
+                             "needed when reading from a pipe (defaults to a hash of the file)")
+    args = parser.parse_args()
+
+    print json.dumps(import_payments(args.payment_file, args.format, args.chunk_size,
+                                     args.source),
+                     indent=2, sort_keys=True)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+import argparse
+import json
+from datetime import datetime
+
+from accounting.nightly import RANGE_SIZE, run_nightly
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bill uninvoiced policies and evaluate "
+                                                 "cancellations across a process pool.")
+    parser.add_argument('--date', help="YYYY-MM-DD to evaluate cancellations for "
+                                       "(defaults to today)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes to run (defaults to one per cpu, 0 runs in this one)")
+    parser.add_argument('--range-size', type=int, default=RANGE_SIZE,
+                        help="policies per unit of work")
+    parser.add_argument('--checkpoint', default="nightly_checkpoint.json",
+                        help="file recording finished ranges, rerun with the same "
+                             "date to resume")
+    args = parser.parse_args()
+
+    date_cursor = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else None
+    summary = run_nightly(date_cursor, args.workers, args.range_size, args.checkpoint)
+    print json.dumps(summary, indent=2, sort_keys=True)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
-from accounting import app
+from accounting import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0')
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from accounting import *
 from accounting.models import *
+from accounting.migrations import *
 from accounting.tools import *
-from flask import *
 
 try:
     from IPython import embed